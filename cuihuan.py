@@ -1,9 +1,22 @@
 # -*- coding: UTF-8 -*-
 
+import os
 import sys
 from tkinter import Button,mainloop
 import  functools,time
+import itertools
+import logging
+import logging.handlers
+import operator
+import queue
 import re
+import threading
+import weakref
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def triangles():
@@ -13,6 +26,115 @@ def triangles():
         a = [sum(i) for i in zip([0]+a, a+[0])]
 
 
+def triangles_inplace():
+    # 每一行都在同一个list上原地更新，产出的始终是同一个对象，需要保留某一行时请自行copy
+    a = [1]
+    while True:
+        yield a
+        a.append(1)
+        a[1:-1] = map(operator.add, a[1:-1], a[:-2])
+
+
+def triangles_numpy(mod=None):
+    # mod为None时用object数组保存任意精度整数，否则用int64按mod取模，适合很深的行
+    if np is None:
+        raise ImportError("numpy is required for triangles_numpy")
+    # 这里只做加法，mod不要求是素数
+    if mod is not None and mod < 2:
+        raise ValueError("mod must be at least 2")
+    if mod is not None and mod >= 2 ** 62:
+        raise ValueError("mod must be smaller than 2**62")
+    a = np.ones(1, dtype=object if mod is None else np.int64)
+    while True:
+        yield a
+        b = np.empty(len(a) + 1, dtype=a.dtype)
+        b[0] = b[-1] = 1
+        np.add(a[1:], a[:-1], out=b[1:-1])
+        if mod is not None:
+            b %= mod
+        a = b
+
+
+def pascal_row(n, mod=None):
+    # 直接计算第n行（从0开始），C(n, k+1) = C(n, k) * (n - k) / (k + 1)，不需要先生成前面的行
+    # mod须为素数：n < mod 时用逆元，n >= mod 时用Lucas定理
+    if n < 0:
+        raise ValueError("n must be non-negative")
+    if mod is None:
+        half = [1]
+        for k in range(n // 2):
+            half.append(half[-1] * (n - k) // (k + 1))
+        return _mirror(half, n)
+    _check_prime(mod)
+    if n < mod:
+        inv = [0, 1] + [0] * (n // 2)
+        for i in range(2, n // 2 + 1):
+            inv[i] = (mod - (mod // i) * inv[mod % i] % mod) % mod
+        half = [1 % mod]
+        for k in range(n // 2):
+            half.append(half[-1] * (n - k) % mod * inv[k + 1] % mod)
+        return _mirror(half, n)
+    return _pascal_row_lucas(n, mod)
+
+
+def _check_prime(p):
+    # 逆元和Lucas定理都只对素数成立，合数会悄悄算出错误的结果
+    if p < 2:
+        raise ValueError("mod must be a prime, got %r" % p)
+    small = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+    if p in small:
+        return
+    if any(p % q == 0 for q in small):
+        raise ValueError("mod must be a prime, got %r" % p)
+    # Miller-Rabin，取前13个素数为底，p < 3.3e24 时结果是确定的
+    d, s = p - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for a in small:
+        x = pow(a, d, p)
+        if x == 1 or x == p - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % p
+            if x == p - 1:
+                break
+        else:
+            raise ValueError("mod must be a prime, got %r" % p)
+
+
+def _mirror(half, n):
+    # 利用对称性，由前半行拼出整行
+    return half + (half[::-1] if n % 2 else half[-2::-1])
+
+
+def _pascal_row_lucas(n, p):
+    fact = [1] * p
+    for i in range(1, p):
+        fact[i] = fact[i - 1] * i % p
+    inv_fact = [1] * p
+    inv_fact[p - 1] = pow(fact[p - 1], p - 2, p)
+    for i in range(p - 1, 0, -1):
+        inv_fact[i - 1] = inv_fact[i] * i % p
+    digits = []
+    m = n
+    while m:
+        digits.append(m % p)
+        m //= p
+    row = []
+    for k in range(n + 1):
+        value = 1
+        for d in digits:
+            kd = k % p
+            k //= p
+            if kd > d:
+                value = 0
+                break
+            value = value * fact[d] % p * inv_fact[kd] % p * inv_fact[d - kd] % p
+        row.append(value)
+    return row
+
+
 n = 0
 
 def createCounter():
@@ -30,30 +152,291 @@ def createCounter1():
     return counter
 
 
-def log(text):
+class AtomicCounter:
+    # 每个计数器自己一把锁，没有全局锁；调用一次加一并返回新值
+    def __init__(self, start=0):
+        self._value = start
+        self._lock = threading.Lock()
+
+    def increment(self, n=1):
+        with self._lock:
+            self._value += n
+            return self._value
+
+    __call__ = increment
+
+    @property
+    def value(self):
+        return self._value
+
+
+class _ShardHolder:
+    # 挂在线程的threading.local上，线程结束时随之释放，触发分片合并
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self):
+        self.shard = [0]
+
+
+class ShardedCounter:
+    # 每个线程只写自己的分片，递增完全不加锁，读取时再把所有分片相加
+    # 线程结束后它的分片合并进_base，每请求一个线程的场景下分片数不会一直增长
+    # 适合写多读少的热点路径；递增不返回总数，总数请读value
+    def __init__(self, start=0):
+        self._start = start
+        self._base = 0
+        self._local = threading.local()
+        self._shards = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        # 新线程登记分片不加锁：next(count)和dict赋值在GIL下都是原子的
+        holder = _ShardHolder()
+        key = next(self._ids)
+        self._shards[key] = holder.shard
+        weakref.finalize(holder, ShardedCounter._fold, weakref.ref(self), key)
+        self._local.holder = holder
+        return holder.shard
+
+    @staticmethod
+    def _fold(counter_ref, key):
+        counter = counter_ref()
+        if counter is None:
+            return
+        with counter._lock:
+            counter._base += counter._shards.pop(key)[0]
+
+    def increment(self, n=1):
+        try:
+            shard = self._local.holder.shard
+        except AttributeError:
+            shard = self._shard()
+        shard[0] += n
+
+    __call__ = increment
+
+    @property
+    def value(self):
+        with self._lock:
+            return self._start + self._base + sum(shard[0] for shard in self._shards.copy().values())
+
+
+class SharedCounter:
+    # 多进程共享计数：共享内存里每个进程一个槽位，进程内的线程用本进程的锁，
+    # 不同进程之间递增互不阻塞；读取时把所有槽位相加
+    # 需要在创建子进程之前构造，并作为参数传给Process/Pool的initializer
+    def __init__(self, start=0, slots=64, context=None):
+        # context: multiprocessing.get_context(...)的返回值，需与创建子进程用的一致
+        if context is None:
+            import multiprocessing as context
+        self._start = start
+        self._slots = context.Array('q', slots + 1, lock=False)
+        self._next_slot = context.Value('i', 0)
+        # 进程数超过slots时，多出来的进程共用最后一个槽位，由这把跨进程锁保护
+        self._overflow_lock = context.Lock()
+        # (pid, 槽位, 锁)作为一个整体替换，线程不会拿到一个槽位配另一个槽位的锁
+        self._attached = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_attached'] = None
+        return state
+
+    def _attach(self):
+        pid = os.getpid()
+        with self._next_slot.get_lock():
+            # 同一进程里几个线程同时第一次递增时，只有第一个分配槽位，其余直接复用
+            attached = self._attached
+            if attached is not None and attached[0] == pid:
+                return attached
+            slot = min(self._next_slot.value, len(self._slots) - 1)
+            self._next_slot.value += 1
+            lock = self._overflow_lock if slot == len(self._slots) - 1 else threading.Lock()
+            attached = self._attached = (pid, slot, lock)
+        return attached
+
+    def increment(self, n=1):
+        attached = self._attached
+        if attached is None or attached[0] != os.getpid():
+            attached = self._attach()
+        pid, slot, lock = attached
+        with lock:
+            self._slots[slot] += n
+
+    __call__ = increment
+
+    @property
+    def value(self):
+        return self._start + sum(self._slots)
+
+
+def createSafeCounter(kind='atomic', start=0):
+    # kind: 'atomic' 线程安全、每次返回新值；'sharded' 按线程分片；'shared' 跨进程共享
+    counters = {'atomic': AtomicCounter, 'sharded': ShardedCounter, 'shared': SharedCounter}
+    return counters[kind](start)
+
+
+logger = logging.getLogger(__name__)
+_queue_logging = None
+
+
+class _InProcessQueueHandler(logging.handlers.QueueHandler):
+    # 队列只在本进程内，记录原样入队，格式化留给listener线程里的handler做
+    def prepare(self, record):
+        return record
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    # 自己记录是否在运行，stop可以重复调用
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.running = False
+
+    def start(self):
+        super().start()
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            super().stop()
+
+
+def setup_queue_logging(handler=None, level=logging.INFO):
+    # 日志记录先进队列，由后台线程的QueueListener交给真正的handler输出，调用方不会被IO阻塞
+    # 返回listener，退出前调用listener.stop()把队列里剩下的记录写完
+    # 重复调用时先停掉上一次的listener并移除它的QueueHandler，记录不会重复输出
+    global _queue_logging
+    if _queue_logging is not None:
+        old_handler, old_listener = _queue_logging
+        logger.removeHandler(old_handler)
+        old_listener.stop()
+    log_queue = queue.SimpleQueue()
+    listener = _QueueListener(log_queue, handler or logging.StreamHandler(), respect_handler_level=True)
+    queue_handler = _InProcessQueueHandler(log_queue)
+    logger.addHandler(queue_handler)
+    # 记录已经由listener输出，不再传给root logger，否则配置过root时会打印两遍
+    logger.propagate = False
+    logger.setLevel(level)
+    listener.start()
+    _queue_logging = (queue_handler, listener)
+    return listener
+
+
+def log(text, level=logging.INFO):
     def decorator(func):
+        @functools.wraps(func)
         def wrapper(*args, **kw):
-            print('%s %s():' % (text, func.__name__))
+            # 级别没开时直接跳过，也不会格式化字符串
+            if logger.isEnabledFor(level):
+                logger.log(level, '%s %s():', text, func.__name__)
             return func(*args, **kw)
         return wrapper
     return decorator
 
 
 def logA(func):
+    @functools.wraps(func)
     def wrapper(*args, **kw):
-        print('call %s():' % func.__name__)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('call %s():', func.__name__)
         return func(*args, **kw)
     return wrapper
 
 
-def metric(fn):
+class FunctionMetric:
+    # 单个函数的耗时统计，histogram按2的幂分桶：第i个桶记录耗时在[2**(i-1), 2**i)纳秒的调用次数
+    __slots__ = ('name', 'sample', 'count', 'total_ns', 'min_ns', 'max_ns', 'histogram', 'lock')
+
+    def __init__(self, name, sample=1):
+        self.name = name
+        self.sample = sample
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+        self.histogram = [0] * 64
+
+    def record(self, ns):
+        with self.lock:
+            self.count += 1
+            self.total_ns += ns
+            if self.min_ns is None or ns < self.min_ns:
+                self.min_ns = ns
+            if ns > self.max_ns:
+                self.max_ns = ns
+            self.histogram[min(ns.bit_length(), 63)] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'estimated_calls': self.count * self.sample,
+                'sample': self.sample,
+                'total_ms': self.total_ns / 1e6,
+                'avg_us': self.total_ns / self.count / 1e3 if self.count else 0,
+                'min_us': (self.min_ns or 0) / 1e3,
+                'max_us': self.max_ns / 1e3,
+                'histogram_us': {'<%g' % ((1 << i) / 1e3): n for i, n in enumerate(self.histogram) if n},
+            }
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def metric(fn=None, sample=1):
+    # 用法：@metric 或 @metric(sample=100)，sample>1时每sample次调用只计时一次
+    if fn is None:
+        return lambda f: metric(f, sample)
+    name = '%s.%s' % (fn.__module__, fn.__qualname__)
+    with _metrics_lock:
+        stats = _metrics.setdefault(name, FunctionMetric(name, sample))
+    clock = time.perf_counter_ns
+
+    if sample <= 1:
+        @functools.wraps(fn)
+        def wrapper(*args, **kw):
+            start = clock()
+            try:
+                return fn(*args, **kw)
+            finally:
+                stats.record(clock() - start)
+        return wrapper
+
+    calls = itertools.count()
+
     @functools.wraps(fn)
     def wrapper(*args, **kw):
-        print('%s executed in %s ms' % (fn.__name__, time.localtime()))
-        return fn(*args, **kw)
+        if next(calls) % sample:
+            return fn(*args, **kw)
+        start = clock()
+        try:
+            return fn(*args, **kw)
+        finally:
+            stats.record(clock() - start)
     return wrapper
 
 
+def dump_metrics():
+    with _metrics_lock:
+        stats_list = list(_metrics.values())
+    return {stats.name: stats.snapshot() for stats in stats_list}
+
+
+def reset_metrics():
+    with _metrics_lock:
+        stats_list = list(_metrics.values())
+    for stats in stats_list:
+        with stats.lock:
+            stats.reset()
+
+
 
 @metric
 def now():
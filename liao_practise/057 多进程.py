@@ -10,6 +10,393 @@
 # 进程间通信是通过Queue、Pipes等实现的。
 
 import os
+import contextlib
+import functools
+import itertools
+import multiprocessing
+import queue
+import struct
+import sys
+import time
+from multiprocessing import shared_memory, util
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# 共享内存环形缓冲区
+# Queue和Pool传递的每个值都要pickle一遍，再经过管道复制到另一个进程，大块的数值数据（图片、数组）代价很高。
+# SharedRingChannel在multiprocessing.shared_memory上划出固定大小的槽位，生产者直接把数据写进槽位，
+# 消费者直接从槽位读，中间不做序列化。
+#
+# 内存布局：
+#   [通道头 64字节] magic、槽位数、槽位大小、写序号、读序号
+#   [槽位0][槽位1]...  每个槽位 = [槽位头 128字节] 数据长度、类型、维数、dtype、shape + [数据]
+# 每个槽位有一对信号量：empty表示可写，full表示可读。生产者/消费者在锁里领一个序号，
+# 序号对槽位数取模就是槽位号，再在这个槽位的信号量上等待。
+# 单生产者单消费者时严格先进先出；多个生产者绕了一圈抢同一个槽位时，顺序可能有交错，但每条消息只会被取走一次。
+
+CHANNEL_HEADER = struct.Struct('<4sIQQQ')   # magic, slots, slot_size, write_seq, read_seq
+CHANNEL_HEADER_SIZE = 64
+WRITE_SEQ_OFFSET, READ_SEQ_OFFSET = 16, 24   # 写序号、读序号在通道头里的偏移
+SLOT_HEADER = struct.Struct('<QBB16s8q')     # nbytes, kind, ndim, dtype, shape
+SLOT_HEADER_SIZE = 128
+KIND_END, KIND_BYTES, KIND_ARRAY = 0, 1, 2
+MAX_DIMS = 8
+
+
+class SharedRingChannel(object):
+
+    def __init__(self, slot_size, slots=4, ctx=None):
+        # slot_size是单条消息最大字节数；ctx可以传入指定启动方式的multiprocessing上下文
+        ctx = ctx or multiprocessing
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = SLOT_HEADER_SIZE + slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=CHANNEL_HEADER_SIZE + self.stride * slots)
+        self.owner = True
+        CHANNEL_HEADER.pack_into(self.shm.buf, 0, b'RING', slots, slot_size, 0, 0)
+        self.write_lock = ctx.Lock()
+        self.read_lock = ctx.Lock()
+        self.empty = [ctx.Semaphore(1) for i in range(slots)]
+        self.full = [ctx.Semaphore(0) for i in range(slots)]
+
+    def __getstate__(self):
+        # 传给子进程时只传共享内存的名字和信号量，子进程里重新attach
+        state = self.__dict__.copy()
+        state['shm'] = self.shm.name
+        state['owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=state['shm'])
+        magic, slots, slot_size = CHANNEL_HEADER.unpack_from(self.shm.buf, 0)[:3]
+        if magic != b'RING' or slots != self.slots or slot_size != self.slot_size:
+            raise ValueError('not a ring channel: %s' % state['shm'])
+
+    def _next_seq(self, lock, offset):
+        with lock:
+            seq = struct.unpack_from('<Q', self.shm.buf, offset)[0]
+            struct.pack_into('<Q', self.shm.buf, offset, seq + 1)
+        return seq % self.slots
+
+    def _payload(self, slot, nbytes):
+        start = CHANNEL_HEADER_SIZE + slot * self.stride + SLOT_HEADER_SIZE
+        return self.shm.buf[start:start + nbytes]
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes, kind=KIND_BYTES, dtype='', shape=()):
+        # 领一个空槽位，把可写的内存视图交给调用方原地填充，退出时标记为可读
+        if nbytes > self.slot_size:
+            raise ValueError('message of %d bytes exceeds slot size %d' % (nbytes, self.slot_size))
+        if len(shape) > MAX_DIMS:
+            raise ValueError('at most %d dimensions' % MAX_DIMS)
+        slot = self._next_seq(self.write_lock, WRITE_SEQ_OFFSET)
+        self.empty[slot].acquire()
+        try:
+            SLOT_HEADER.pack_into(self.shm.buf, CHANNEL_HEADER_SIZE + slot * self.stride, nbytes, kind, len(shape),
+                                  dtype.encode(), *(tuple(shape) + (0,) * (MAX_DIMS - len(shape))))
+            view = self._payload(slot, nbytes)
+            try:
+                yield view
+            finally:
+                view.release()
+        finally:
+            self.full[slot].release()
+
+    def send(self, data):
+        # data可以是bytes/bytearray/memoryview或者NumPy数组；None表示结束
+        if data is None:
+            with self.reserve(0, KIND_END):
+                return
+        if np is not None and isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data)
+            with self.reserve(data.nbytes, KIND_ARRAY, data.dtype.str, data.shape) as view:
+                np.frombuffer(view, dtype=np.uint8)[:] = data.reshape(-1).view(np.uint8)
+            return
+        data = memoryview(data).cast('B')
+        with self.reserve(data.nbytes) as view:
+            view[:] = data
+
+    @contextlib.contextmanager
+    def receive(self):
+        # 零拷贝读取：得到直接指向槽位的memoryview或NumPy数组，退出with之前有效，退出后槽位交还生产者
+        slot = self._next_seq(self.read_lock, READ_SEQ_OFFSET)
+        self.full[slot].acquire()
+        try:
+            header = SLOT_HEADER.unpack_from(self.shm.buf, CHANNEL_HEADER_SIZE + slot * self.stride)
+            nbytes, kind, ndim, dtype = header[:4]
+            if kind == KIND_END:
+                yield None
+                return
+            view = self._payload(slot, nbytes)
+            try:
+                if kind == KIND_ARRAY:
+                    array = np.frombuffer(view, dtype=dtype.rstrip(b'\0').decode()).reshape(header[4:4 + ndim])
+                    try:
+                        yield array
+                    finally:
+                        del array
+                else:
+                    yield view
+            finally:
+                view.release()
+        finally:
+            self.empty[slot].release()
+
+    def recv(self):
+        # 读取一条消息并复制出来，返回bytes、NumPy数组或者None(结束)
+        with self.receive() as data:
+            if data is None:
+                return None
+            return data.copy() if np is not None and isinstance(data, np.ndarray) else data.tobytes()
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _ring_producer(channel, payload, count):
+    for i in range(count):
+        channel.send(payload)
+    channel.send(None)
+
+
+def _queue_producer(q, payload, count):
+    for i in range(count):
+        q.put(payload)
+    q.put(None)
+
+
+def bench_ring_channel(sizes=(1024, 1024 * 1024, 64 * 1024 * 1024), total=256 * 1024 * 1024):
+    # 对每种消息大小，子进程发送约total字节（至少8条），主进程接收，比较Queue和共享内存通道的吞吐
+    from multiprocessing import Process, Queue
+    for size in sizes:
+        count = max(8, min(total // size, 20000))
+        payload = np.ones(size, dtype=np.uint8) if np is not None else b'x' * size
+        results = {}
+        for name in ('Queue', 'SharedRingChannel'):
+            channel = Queue(maxsize=4) if name == 'Queue' else SharedRingChannel(size, slots=4)
+            producer = Process(target=_queue_producer if name == 'Queue' else _ring_producer,
+                               args=(channel, payload, count))
+            begin = time.perf_counter()
+            producer.start()
+            received = 0
+            while True:
+                data = channel.get() if name == 'Queue' else channel.recv()
+                if data is None:
+                    break
+                received += 1
+            elapsed = time.perf_counter() - begin
+            producer.join()
+            if name != 'Queue':
+                channel.close()
+            results[name] = count / elapsed
+            print('%-18s %9d bytes x %5d: %10.1f msg/s %8.1f MB/s' % (
+                name, size, received, count / elapsed, count * size / elapsed / 1024 / 1024))
+        print('speedup: %.1fx' % (results['SharedRingChannel'] / results['Queue']))
+
+
+# 流式并行map
+# 下面Pool的例子每个元素单独apply_async一次，一个元素就是一次进程间通信，而且所有未取走的结果都堆在内存里。
+# stream_map把输入按块提交，块大小根据每个元素的实际耗时自动调整（目标是每块约target_seconds秒），
+# 同时在途的块数不超过max_in_flight，消费者取得慢，就暂停从输入里读取（背压），
+# 所以输入可以是无限的生成器，内存占用只和max_in_flight * 块大小有关。
+
+MAX_CHUNKSIZE = 10000
+
+
+def _map_chunk(func, chunk):
+    begin = time.perf_counter()
+    return [func(x) for x in chunk], time.perf_counter() - begin
+
+
+def stream_map(func, iterable, processes=None, ordered=True, max_in_flight=None, chunksize=None,
+               target_seconds=0.05, pool=None):
+    # ordered为True时按输入顺序产出结果，否则哪块先算完先产出
+    # chunksize为None时自适应；pool可以传入已有的进程池（不会被关闭）
+    processes = processes or os.cpu_count() or 1
+    max_in_flight = max_in_flight or processes * 2
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(processes)
+    done = queue.Queue()
+    it = iter(iterable)
+    size = chunksize or 1
+    submitted = released = 0    # 已提交的块数、已产出的块数
+    finished = {}               # 有序模式下先算完、还没轮到产出的块
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and submitted - released < max_in_flight:
+                chunk = list(itertools.islice(it, size))
+                if not chunk:
+                    exhausted = True
+                    break
+                pool.apply_async(_map_chunk, (func, chunk),
+                                 callback=lambda r, seq=submitted: done.put((seq, r, None)),
+                                 error_callback=lambda e, seq=submitted: done.put((seq, None, e)))
+                submitted += 1
+            if released == submitted:
+                return
+            seq, result, error = done.get()
+            if error is not None:
+                raise error
+            results, elapsed = result
+            if chunksize is None:
+                per_item = elapsed / len(results)
+                wanted = int(target_seconds / per_item) if per_item else MAX_CHUNKSIZE
+                size = max(1, min(wanted, size * 2, MAX_CHUNKSIZE))
+            if not ordered:
+                released += 1
+                yield from results
+                continue
+            finished[seq] = results
+            while released in finished:
+                results = finished.pop(released)
+                released += 1
+                yield from results
+    finally:
+        # 在途的块数有上限，提前退出时等它们算完即可，比terminate稳妥
+        if own_pool:
+            pool.close()
+            pool.join()
+
+
+def _square(x):
+    return x * x
+
+
+def bench_stream_map(count=200000):
+    # 对比逐个apply_async和stream_map处理count个小任务的耗时
+    from multiprocessing import Pool
+    begin = time.perf_counter()
+    with Pool() as pool:
+        pending = [pool.apply_async(_square, (i,)) for i in range(count)]
+        total = sum(r.get() for r in pending)
+    print('apply_async: %.2fs' % (time.perf_counter() - begin))
+    for ordered in (True, False):
+        begin = time.perf_counter()
+        assert sum(stream_map(_square, iter(range(count)), ordered=ordered)) == total
+        print('stream_map(ordered=%s): %.2fs' % (ordered, time.perf_counter() - begin))
+
+
+# 预热的进程池
+# 加载字体、模型、建立数据库连接这类准备工作如果放在任务函数里，每个任务都要重复一遍。
+# WarmPool在每个工作进程启动时调用一次state_factory(*initargs)，得到的状态对象保存在进程里，
+# 之后这个进程处理的所有任务都把它作为第一个参数传给任务函数，任务耗时就只剩真正的计算。
+# 默认用forkserver方式启动工作进程：不会把父进程里的线程、锁、打开的连接一起复制过去，又比spawn启动快；
+# maxtasksperchild可以让进程处理一定数量的任务后退出重建，防止内存泄漏越积越多。
+# 状态对象如果有close方法，进程正常退出时会被调用。
+
+_worker_state = None
+
+
+def _init_warm_worker(state_factory, initargs):
+    global _worker_state
+    _worker_state = state_factory(*initargs)
+    if hasattr(_worker_state, 'close'):
+        util.Finalize(_worker_state, _worker_state.close, exitpriority=10)
+
+
+def _call_with_state(func, *args):
+    return func(_worker_state, *args)
+
+
+class WarmPool(object):
+
+    def __init__(self, state_factory, initargs=(), processes=None, maxtasksperchild=None,
+                 start_method='forkserver', preload=()):
+        # preload是forkserver进程里预先导入的模块名，之后每个工作进程都从它fork，不用重复导入
+        if start_method not in multiprocessing.get_all_start_methods():
+            start_method = None
+        ctx = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver' and preload:
+            ctx.set_forkserver_preload(list(preload))
+        self.pool = ctx.Pool(processes, _init_warm_worker, (state_factory, initargs), maxtasksperchild)
+
+    def apply(self, func, *args):
+        return self.pool.apply(_call_with_state, (func,) + args)
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        return self.pool.apply_async(_call_with_state, (func,) + tuple(args), callback=callback,
+                                     error_callback=error_callback)
+
+    def map(self, func, iterable, chunksize=None):
+        return self.pool.map(functools.partial(_call_with_state, func), iterable, chunksize)
+
+    def imap(self, func, iterable, **kwargs):
+        # 流式处理，参数同stream_map
+        return stream_map(functools.partial(_call_with_state, func), iterable, pool=self.pool, **kwargs)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _SlowSetup(object):
+    # 演示用的状态对象：创建时模拟一次耗时的加载
+    def __init__(self, seconds):
+        time.sleep(seconds)
+        self.pid = os.getpid()
+        self.tasks = 0
+
+
+def _cold_task(x, seconds):
+    state = _SlowSetup(seconds)
+    return state.pid, x * x
+
+
+def _warm_task(state, x):
+    state.tasks += 1
+    return state.pid, x * x
+
+
+def bench_warm_pool(count=40, setup_seconds=0.1):
+    # 比较每个任务自己做准备工作和在WarmPool里复用状态的单任务延迟，以及maxtasksperchild回收进程的效果
+    from multiprocessing import Pool
+    with Pool() as pool:
+        begin = time.perf_counter()
+        for i in range(count):
+            pool.apply(_cold_task, (i, setup_seconds))
+        print('cold: %.1f ms/task' % ((time.perf_counter() - begin) / count * 1000))
+    with WarmPool(_SlowSetup, (setup_seconds,)) as pool:
+        pool.apply(_warm_task, 0)
+        begin = time.perf_counter()
+        for i in range(count):
+            pool.apply(_warm_task, i)
+        print('warm: %.1f ms/task' % ((time.perf_counter() - begin) / count * 1000))
+    with WarmPool(_SlowSetup, (setup_seconds,), maxtasksperchild=10) as pool:
+        pids = set(pid for pid, r in pool.map(_warm_task, range(count), chunksize=1))
+        print('maxtasksperchild=10: %d tasks ran in %d worker processes' % (count, len(pids)))
+
+
+if __name__ == '__main__' and sys.argv[1:2] == ['warm']:
+    # python "057 多进程.py" warm
+    bench_warm_pool()
+    sys.exit()
+
+
+if __name__ == '__main__' and sys.argv[1:2] == ['map']:
+    # python "057 多进程.py" map
+    bench_stream_map()
+    sys.exit()
+
+
+if __name__ == '__main__' and sys.argv[1:2] == ['bench']:
+    # python "057 多进程.py" bench   比较Queue和共享内存通道在1KB/1MB/64MB消息下的吞吐
+    bench_ring_channel()
+    sys.exit()
 
 
 if __name__ == '__main__':
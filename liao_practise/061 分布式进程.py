@@ -17,6 +17,7 @@
 
 # 我们先看服务进程，服务进程负责启动Queue，把Queue注册到网络上，然后往Queue里面写入任务
 import time, random, queue
+import collections, functools, itertools, os, sys, threading
 from multiprocessing.managers import BaseManager
 
 # 发送任务的队列
@@ -30,6 +31,406 @@ class QueueManager(BaseManager):
     pass
 
 
+# 上面的例子里，worker取走任务后如果挂掉，这个任务就丢了。
+# 下面的TaskMaster给每个任务分配ID，worker取任务时拿到一个租约(lease)，处理过程中定期发心跳续约；
+# 租约到期还没交结果的任务会被重新放回队列，交给别的worker处理。结果带着任务ID返回，不会对错。
+
+class TaskMaster(object):
+    # 运行在manager的服务进程里，所有worker通过代理调用它的方法
+
+    def __init__(self, lease_seconds=30, max_attempts=None):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Condition()
+        self.ids = itertools.count(1)
+        self.pending = collections.deque()   # 等待分配的任务ID，可能残留已经完成的ID，fetch时跳过
+        self.queued = set()                  # pending里仍然有效的任务ID
+        self.tasks = {}                      # 任务ID -> [payload, 已尝试次数]
+        self.leases = {}                     # 任务ID -> (worker_id, 租约到期时间)
+        self.results = queue.Queue()         # (任务ID, 是否成功, 结果)
+        self.closed = False
+        reaper = threading.Thread(target=self._reap, daemon=True)
+        reaper.start()
+
+    def submit(self, payload):
+        with self.lock:
+            task_id = next(self.ids)
+            self.tasks[task_id] = [payload, 0]
+            self.pending.append(task_id)
+            self.queued.add(task_id)
+            self.lock.notify()
+            return task_id
+
+    def fetch(self, worker_id, timeout=None):
+        # 返回(任务ID, payload, 租约秒数)；超时或已关闭返回None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while not self.queued:
+                if self.closed:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+            task_id = self.pending.popleft()
+            while task_id not in self.queued:
+                task_id = self.pending.popleft()
+            self.queued.remove(task_id)
+            task = self.tasks[task_id]
+            task[1] += 1
+            self.leases[task_id] = (worker_id, time.monotonic() + self.lease_seconds)
+            return task_id, task[0], self.lease_seconds
+
+    def heartbeat(self, worker_id, task_id):
+        # 续约；返回False说明租约已经过期并转给了别的worker
+        with self.lock:
+            lease = self.leases.get(task_id)
+            if lease is None or lease[0] != worker_id:
+                return False
+            self.leases[task_id] = (worker_id, time.monotonic() + self.lease_seconds)
+            return True
+
+    def complete(self, worker_id, task_id, result):
+        # 同一个任务只接受第一份结果，重复提交返回False
+        with self.lock:
+            if task_id not in self.tasks:
+                return False
+            del self.tasks[task_id]
+            self.leases.pop(task_id, None)
+            # 过期后重新排队的任务被原worker迟交完成，pending里的ID留给fetch跳过
+            self.queued.discard(task_id)
+            if not self.queued:
+                self.pending.clear()
+        self.results.put((task_id, True, result))
+        return True
+
+    def fail(self, worker_id, task_id, error):
+        # worker处理出错，按重试次数决定重新排队还是直接报失败
+        with self.lock:
+            lease = self.leases.get(task_id)
+            if lease is None or lease[0] != worker_id:
+                return False
+            del self.leases[task_id]
+            if self._retry(task_id):
+                return True
+            del self.tasks[task_id]
+        self.results.put((task_id, False, error))
+        return True
+
+    def _retry(self, task_id):
+        # 调用方持有锁
+        if self.max_attempts is not None and self.tasks[task_id][1] >= self.max_attempts:
+            return False
+        self.pending.append(task_id)
+        self.queued.add(task_id)
+        self.lock.notify()
+        return True
+
+    def requeue_expired(self):
+        now = time.monotonic()
+        failed = []
+        with self.lock:
+            for task_id, (worker_id, deadline) in list(self.leases.items()):
+                if deadline <= now:
+                    del self.leases[task_id]
+                    if not self._retry(task_id):
+                        del self.tasks[task_id]
+                        failed.append(task_id)
+        for task_id in failed:
+            self.results.put((task_id, False, 'lease expired'))
+        return len(failed)
+
+    def _reap(self):
+        while not self.closed:
+            time.sleep(max(self.lease_seconds / 4, 0.05))
+            self.requeue_expired()
+
+    def get_result(self, timeout=None):
+        # 返回(任务ID, 是否成功, 结果)，超时抛出queue.Empty
+        return self.results.get(timeout=timeout)
+
+    def stats(self):
+        with self.lock:
+            return {'pending': len(self.queued), 'leased': len(self.leases), 'unfinished': len(self.tasks),
+                    'results': self.results.qsize()}
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+
+_task_master = None
+_task_master_options = {}
+
+
+def _configure_task_master(options):
+    # 作为manager.start的initializer在服务进程里执行；spawn方式下服务进程重新导入本模块，
+    # 在父进程里改全局变量不会带过去，所以参数要这样显式传入
+    _task_master_options.update(options)
+
+
+def _get_task_master():
+    # 在manager的服务进程里第一次被调用时创建，之后所有连接共用同一个TaskMaster
+    global _task_master
+    if _task_master is None:
+        _task_master = TaskMaster(**_task_master_options)
+    return _task_master
+
+
+class TaskMasterManager(QueueManager):
+    pass
+
+
+TaskMasterManager.register('get_task_master', callable=_get_task_master)
+
+
+def start_task_master(address=('127.0.0.1', 5001), authkey=b'abc', **options):
+    # 启动服务进程，返回(manager, TaskMaster代理)，options传给TaskMaster
+    manager = TaskMasterManager(address=address, authkey=authkey)
+    manager.start(_configure_task_master, (options,))
+    return manager, manager.get_task_master()
+
+
+def run_worker(func, address=('127.0.0.1', 5001), authkey=b'abc', worker_id=None, idle_timeout=None,
+               state_factory=None, initargs=(), max_tasks=None):
+    # 连接TaskMaster循环取任务执行，处理期间后台线程按租约的1/3发心跳
+    # TaskMaster关闭或空闲超过idle_timeout后退出，返回处理的任务数
+    # 给了state_factory时，启动时调用一次state_factory(*initargs)预热（加载模型、建立连接等），
+    # 之后每个任务调用func(state, payload)复用它；max_tasks限制单个worker处理的任务数，到数后退出由外部重启，防止内存泄漏
+    state = state_factory(*initargs) if state_factory is not None else None
+    worker_id = worker_id or '%s-%s' % (os.uname()[1] if hasattr(os, 'uname') else 'host', os.getpid())
+    manager = TaskMasterManager(address=address, authkey=authkey)
+    manager.connect()
+    master = manager.get_task_master()
+    done = 0
+    while max_tasks is None or done < max_tasks:
+        task = master.fetch(worker_id, idle_timeout)
+        if task is None:
+            return done
+        task_id, payload, lease_seconds = task
+        finished = threading.Event()
+
+        def beat():
+            # 代理对象在每个线程里各自建立连接，心跳线程可以直接用master
+            while not finished.wait(lease_seconds / 3):
+                if not master.heartbeat(worker_id, task_id):
+                    return
+
+        heartbeat = threading.Thread(target=beat, daemon=True)
+        heartbeat.start()
+        try:
+            result = func(payload) if state_factory is None else func(state, payload)
+        except Exception as e:
+            finished.set()
+            master.fail(worker_id, task_id, repr(e))
+        else:
+            finished.set()
+            master.complete(worker_id, task_id, result)
+            done += 1
+        heartbeat.join()
+    return done
+
+
+# 原来的例子每个task.put(n)、result.get()都是一次网络往返加一次pickle，小任务每秒只能传几千个。
+# BatchQueue支持一次传一批：put_many一次放进多个，get_many一次取走多个，
+# 取的时候可以多等linger秒凑满一批；客户端的Batcher负责把单个put攒成批。
+
+class BatchQueue(object):
+    # 运行在服务进程里，可以一次存取多个元素的队列；close之后取空了get_many返回空列表
+
+    def __init__(self):
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def put(self, item):
+        self.put_many([item])
+
+    def put_many(self, items):
+        with self.cond:
+            self.items.extend(items)
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        items = self.get_many(1, timeout)
+        if not items:
+            raise queue.Empty
+        return items[0]
+
+    def get_many(self, max_items, timeout=None, linger=0):
+        # 等到至少有一个元素，再最多等linger秒凑满max_items个
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while not self.items:
+                if self.closed:
+                    return []
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return []
+                self.cond.wait(remaining)
+            linger_deadline = time.monotonic() + linger
+            while len(self.items) < max_items and not self.closed:
+                remaining = linger_deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return [self.items.popleft() for i in range(min(max_items, len(self.items)))]
+
+    def qsize(self):
+        return len(self.items)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class Batcher(object):
+    # 客户端缓冲：攒够batch_size个，或者最早的元素已经等了linger秒，就用一次put_many发出去
+    # 没有后台线程，最后剩下的元素要调用flush（或者用with）发出
+
+    def __init__(self, target, batch_size=100, linger=0.01):
+        self.target = target
+        self.batch_size = batch_size
+        self.linger = linger
+        self.buffer = []
+        self.first = None
+
+    def put(self, item):
+        if not self.buffer:
+            self.first = time.monotonic()
+        self.buffer.append(item)
+        if len(self.buffer) >= self.batch_size or time.monotonic() - self.first >= self.linger:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.target.put_many(self.buffer)
+            self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+_batch_queues = {}
+
+
+def _get_batch_queue(name):
+    # 服务进程里按名字创建的BatchQueue
+    if name not in _batch_queues:
+        _batch_queues[name] = BatchQueue()
+    return _batch_queues[name]
+
+
+class BatchQueueManager(QueueManager):
+    pass
+
+
+BatchQueueManager.register('get_batch_task_queue', callable=functools.partial(_get_batch_queue, 'task'))
+BatchQueueManager.register('get_batch_result_queue', callable=functools.partial(_get_batch_queue, 'result'))
+
+
+def batch_worker(address=('127.0.0.1', 5002), authkey=b'abc', batch_size=100, linger=0.01):
+    # 每次取一批任务，算完整批结果一次发回；batch_size为1时就是逐个传输
+    manager = BatchQueueManager(address=address, authkey=authkey)
+    manager.connect()
+    task = manager.get_batch_task_queue()
+    result = manager.get_batch_result_queue()
+    while True:
+        if batch_size == 1:
+            try:
+                result.put(task.get() ** 2)
+            except queue.Empty:
+                return
+            continue
+        batch = task.get_many(batch_size, linger=linger)
+        if not batch:
+            return
+        result.put_many([n * n for n in batch])
+
+
+def bench_transfer(worker_count, batch_size, task_count, linger=0.01, address=('127.0.0.1', 5002)):
+    # 返回每秒完成的任务数
+    import multiprocessing
+    manager = BatchQueueManager(address=address, authkey=b'abc')
+    manager.start()
+    task = manager.get_batch_task_queue()
+    result = manager.get_batch_result_queue()
+    workers = [multiprocessing.Process(target=batch_worker, args=(address, b'abc', batch_size, linger))
+               for i in range(worker_count)]
+    for w in workers:
+        w.start()
+    begin = time.perf_counter()
+    with Batcher(task, batch_size, linger) as batcher:
+        for n in range(task_count):
+            batcher.put(n)
+    received = 0
+    while received < task_count:
+        received += len(result.get_many(batch_size))
+    elapsed = time.perf_counter() - begin
+    task.close()
+    for w in workers:
+        w.join()
+    manager.shutdown()
+    return task_count / elapsed
+
+
+def transfer_benchmark(task_count=20000):
+    for worker_count in (1, 4, 16):
+        for batch_size in (1, 100):
+            rate = bench_transfer(worker_count, batch_size, task_count if batch_size > 1 else task_count // 10)
+            print('%2d workers, batch %3d: %8.0f tasks/sec' % (worker_count, batch_size, rate))
+
+
+def square_task(n):
+    # 演示用的任务：模拟耗时计算
+    time.sleep(random.random())
+    return n * n
+
+
+def task_master_demo(worker_count=4, task_count=20):
+    # 本机启动TaskMaster和几个worker进程，其中一个worker中途被杀掉，它手上的任务会在租约到期后被重新分配
+    import multiprocessing
+    manager, master = start_task_master(lease_seconds=2)
+    for i in range(task_count):
+        n = random.randint(0, 10000)
+        print('Put task %d: %d...' % (master.submit(n), n))
+    workers = [multiprocessing.Process(target=run_worker, args=(square_task,), kwargs={'idle_timeout': 5})
+               for i in range(worker_count)]
+    for w in workers:
+        w.start()
+    time.sleep(1)
+    workers[0].terminate()
+    for i in range(task_count):
+        task_id, ok, r = master.get_result(timeout=30)
+        print('Result of task %d: %s' % (task_id, r))
+    master.close()
+    for w in workers:
+        w.join()
+    manager.shutdown()
+    print('master exit.')
+
+
+if __name__ == '__main__' and sys.argv[1:2] == ['bench']:
+    # python "061 分布式进程.py" bench [任务数]   比较逐个传输和批量传输的吞吐
+    transfer_benchmark(*[int(a) for a in sys.argv[2:3]])
+    sys.exit()
+
+
+if __name__ == '__main__' and sys.argv[1:2] == ['tasks']:
+    # python "061 分布式进程.py" tasks        本机演示带租约的TaskMaster
+    # python "061 分布式进程.py" tasks worker IP  在另一台机器上启动worker连接到master
+    if sys.argv[2:3] == ['worker']:
+        print('worker done %d tasks.' % run_worker(square_task, address=(sys.argv[3], 5001)))
+    else:
+        task_master_demo()
+    sys.exit()
+
+
 if __name__ == '__main__':
     # 把两个Queue都注册到网络上，callable 参数关联了Queue对象
     QueueManager.register("get_task_queue", callable=lambda: task_queue)
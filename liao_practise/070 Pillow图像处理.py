@@ -5,7 +5,80 @@
 # https://pillow.readthedocs.org/
 
 from PIL import Image, ImageFilter, ImageDraw, ImageFont
+import functools
+import io
+import os
 import random
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# 批量生成验证码
+# 逐像素draw.point()每张图要调用上万次，这里改成一次生成整块随机噪声再用Image.frombuffer变成图片，
+# 字体对象缓存起来复用，多张验证码分批交给进程池并行生成
+
+# 把0~255映射到64~255，没有numpy时直接用os.urandom的随机字节生成背景
+_NOISE_TABLE = bytes(64 + b * 192 // 256 for b in range(256))
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(path='Arial.ttf', size=36):
+    # 同一进程内每种字体只加载一次
+    try:
+        return ImageFont.truetype(path, size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def noise_background(width, height, seed=None):
+    # 一次生成整张图的随机颜色，每个通道取值64~255，与randColor()一致
+    if np is not None:
+        pixels = np.random.default_rng(seed).integers(64, 256, size=(height, width, 3), dtype=np.uint8)
+        return Image.frombuffer('RGB', (width, height), pixels, 'raw', 'RGB', 0, 1)
+    pixels = os.urandom(width * height * 3).translate(_NOISE_TABLE)
+    return Image.frombuffer('RGB', (width, height), pixels, 'raw', 'RGB', 0, 1)
+
+
+def generate_captcha(text=None, width=240, height=60, font_path='Arial.ttf', font_size=36, seed=None):
+    # 返回(验证码文字, Image)
+    rnd = random.Random(seed)
+    if text is None:
+        text = ''.join(chr(rnd.randint(65, 90)) for _ in range(4))
+    image = noise_background(width, height, seed)
+    draw = ImageDraw.Draw(image)
+    font = load_font(font_path, font_size)
+    step = width // len(text)
+    for t, char in enumerate(text):
+        color = (rnd.randint(32, 127), rnd.randint(32, 127), rnd.randint(32, 127))
+        draw.text((step * t + 10, 10), char, font=font, fill=color)
+    return text, image.filter(ImageFilter.BLUR)
+
+
+def captcha_batch(count, seed, image_format='jpeg', **kw):
+    # 在子进程里生成一批验证码，返回[(文字, 编码后的图片bytes)]，每批用不同的种子
+    rnd = random.Random(seed)
+    result = []
+    for _ in range(count):
+        text, image = generate_captcha(seed=rnd.getrandbits(64), **kw)
+        buf = io.BytesIO()
+        image.save(buf, image_format)
+        result.append((text, buf.getvalue()))
+    return result
+
+
+def generate_captchas(count, processes=None, batch_size=256, image_format='jpeg', **kw):
+    # 用进程池批量生成count张验证码，按批产出(文字, 图片bytes)
+    batches = [min(batch_size, count - start) for start in range(0, count, batch_size)]
+    seeds = [random.SystemRandom().getrandbits(64) for _ in batches]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(captcha_batch, n, seed, image_format, **kw) for n, seed in zip(batches, seeds)]
+        for future in futures:
+            yield from future.result()
+
 
 if __name__ == '__main__':
     # 打开一个jpg图像文件，注意是当前路径:
@@ -1,52 +1,1726 @@
+import collections
+import csv
+import hashlib
+import json
+import math
+import mmap
 import os
+import queue
 import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class CommandError(RuntimeError):
+    def __init__(self, result):
+        status = "timed out" if result.timed_out else "exited with %s" % result.returncode
+        super().__init__("%s %s: %s" % (" ".join(result.args), status,
+                                        (result.stderr or b"").decode("utf-8", "ignore").strip()[-500:]))
+        self.result = result
+
+    def __reduce__(self):
+        # 识别进程池里抛出的异常要能pickle回主进程
+        return CommandError, (self.result,)
+
+
+class CommandResult:
+    def __init__(self, args, returncode, stdout, stderr, wall_time, timed_out=False):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.wall_time = wall_time
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def check(self):
+        if not self.ok:
+            raise CommandError(self)
+        return self
+
+
+class RunningCommand:
+    """
+    已启动但还没结束的子进程，stderr写到临时文件，避免管道写满卡住子进程
+    给了timeout时由后台计时器到点杀掉进程，边读stdout边处理的场景也不会无限期卡住
+    """
+
+    def __init__(self, runner, args, label, stdout, timeout=None):
+        self.runner = runner
+        self.args = args
+        self.label = label
+        self.stderr_file = tempfile.TemporaryFile()
+        self.started = time.perf_counter()
+        self.process = subprocess.Popen(args, stdout=stdout, stderr=self.stderr_file)
+        self.timed_out = False
+        self.watchdog = None
+        if timeout is not None:
+            self.watchdog = threading.Timer(timeout, self._expire)
+            self.watchdog.daemon = True
+            self.watchdog.start()
+
+    def _expire(self):
+        if self.process.poll() is None:
+            self.timed_out = True
+            self.process.kill()
+
+    @property
+    def stdout(self):
+        return self.process.stdout
+
+    def poll(self):
+        return self.process.poll()
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+
+    def wait(self, timeout=None):
+        # 先关闭stdout再等待，读取方提前停止时子进程写管道会失败退出，而不是一直卡住
+        if self.process.stdout is not None:
+            self.process.stdout.close()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+            self.timed_out = True
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+        timed_out = self.timed_out
+        self.stderr_file.seek(0)
+        stderr = self.stderr_file.read()
+        self.stderr_file.close()
+        result = CommandResult(self.args, self.process.returncode, None, stderr,
+                               time.perf_counter() - self.started, timed_out)
+        self.runner.record(result, self.label)
+        return result
+
+
+class CommandRunner:
+    """
+    子进程执行层：参数用列表传递不经过shell，路径里有空格或中文也不会出错；
+    支持超时、捕获stderr、并发启动，并记录每次调用的耗时
+    """
+
+    def __init__(self, timeout=None, max_workers=None, history=10000):
+        """
+        :param:
+            timeout：默认超时时间（秒），None为不限
+            max_workers：submit并发执行时的线程数上限
+            history：保留最近多少次调用的耗时记录
+        """
+        self.timeout = timeout
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.history = collections.deque(maxlen=history)
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def record(self, result, label=None):
+        program = os.path.basename(result.args[0])
+        with self.lock:
+            self.history.append((program, label, result.wall_time, result.returncode, result.timed_out))
+            count, total, slowest = self.totals.get(program, (0, 0.0, 0.0))
+            self.totals[program] = (count + 1, total + result.wall_time, max(slowest, result.wall_time))
+
+    def run(self, args, input=None, timeout=None, label=None, capture_stdout=True):
+        """
+        :param:
+            args：参数列表
+            label：记录耗时时附带的标识，比如视频名、帧文件名
+        :return:
+            CommandResult
+        """
+        timeout = self.timeout if timeout is None else timeout
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            p = subprocess.run(args, input=input, timeout=timeout,
+                               stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+            returncode, stdout, stderr = p.returncode, p.stdout, p.stderr
+        except subprocess.TimeoutExpired as e:
+            returncode, stdout, stderr = None, e.stdout, e.stderr or b""
+            timed_out = True
+        result = CommandResult(args, returncode, stdout, stderr, time.perf_counter() - started, timed_out)
+        self.record(result, label)
+        return result
+
+    def start(self, args, label=None, stdout=subprocess.DEVNULL, timeout=None):
+        """
+        启动后立即返回RunningCommand，适合边运行边读输出的场景
+        :param:
+            timeout：从启动算起的期限（秒），到点杀掉进程，默认用runner的timeout
+        """
+        timeout = self.timeout if timeout is None else timeout
+        return RunningCommand(self, args, label, stdout, timeout)
+
+    def submit(self, args, **kwargs):
+        """
+        :return:
+            Future，结果为CommandResult
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self.executor.submit(self.run, args, **kwargs)
+
+    def run_all(self, args_list, **kwargs):
+        """
+        并发启动一批命令，按输入顺序返回结果
+        """
+        return [future.result() for future in [self.submit(args, **kwargs) for args in args_list]]
+
+    def stats(self):
+        """
+        :return:
+            {程序名: {"count", "total_seconds", "max_seconds"}}
+        """
+        with self.lock:
+            return {program: {"count": count, "total_seconds": total, "max_seconds": slowest}
+                    for program, (count, total, slowest) in self.totals.items()}
+
+    def slowest(self, n=10):
+        """
+        :return:
+            最慢的n次调用(程序名, 标识, 耗时, 返回码, 是否超时)
+        """
+        with self.lock:
+            return sorted(self.history, key=lambda item: item[2], reverse=True)[:n]
+
+
+default_runner = CommandRunner()
+
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg")
+
+
+def list_frame_images(image_path):
+    return sorted(name for name in os.listdir(image_path) if name.lower().endswith(IMAGE_SUFFIXES))
+
+
+class PipelineManifest:
+    """
+    分帧/识别的断点记录，manifest_dir下每个视频一个小文件：
+        <视频名>.json：视频哈希、大小、修改时间、分帧参数和分出的帧
+        <视频名>.ocr：追加写的识别进度，每行一个已识别的帧名，识别结果本身只在各自的data文件里
+    记录一个视频或一批识别进度只写这个视频自己的文件，与视频总数和已识别的帧数无关
+    """
+
+    def __init__(self, manifest_dir):
+        self.manifest_dir = manifest_dir
+        self.lock = threading.RLock()
+        self.videos = {}
+        os.makedirs(manifest_dir, exist_ok=True)
+
+    def entry_path(self, video_name):
+        return os.path.join(self.manifest_dir, video_name + ".json")
+
+    def journal_path(self, video_name):
+        return os.path.join(self.manifest_dir, video_name + ".ocr")
+
+    def entry(self, video_name):
+        with self.lock:
+            if video_name not in self.videos:
+                entry = None
+                if os.path.exists(self.entry_path(video_name)):
+                    with open(self.entry_path(video_name), "r") as f:
+                        entry = json.load(f)
+                self.videos[video_name] = entry
+            return self.videos[video_name]
+
+    @staticmethod
+    def file_hash(file_path, chunk_size=1024 * 1024):
+        sha1 = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def video_signature(self, video_file_path, video_name):
+        """
+        大小和修改时间都没变时直接沿用上次的哈希，避免每次重读整个视频
+        """
+        st = os.stat(video_file_path)
+        entry = self.entry(video_name)
+        if entry and entry.get("size") == st.st_size and entry.get("mtime") == st.st_mtime_ns:
+            return entry["hash"], st
+        return self.file_hash(video_file_path), st
+
+    def is_extracted(self, video_name, video_hash, jpg_dir_path, sampling=None):
+        """
+        :param:
+            sampling：分帧参数，参数变了也要重新分帧
+        """
+        entry = self.entry(video_name)
+        return (bool(entry) and entry["hash"] == video_hash and entry.get("sampling") == sampling
+                and os.path.isdir(jpg_dir_path))
+
+    def record_video(self, video_name, video_hash, st, frames, sampling=None):
+        """
+        重新分帧后之前的识别进度作废
+        """
+        entry = {
+            "hash": video_hash,
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "sampling": sampling,
+            "frames": frames,
+        }
+        with self.lock:
+            self.reset_ocr(video_name)
+            tmp_path = self.entry_path(video_name) + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self.entry_path(video_name))
+            self.videos[video_name] = entry
+
+    def forget_video(self, video_name):
+        with self.lock:
+            self.reset_ocr(video_name)
+            if os.path.exists(self.entry_path(video_name)):
+                os.remove(self.entry_path(video_name))
+            self.videos[video_name] = None
+
+    def video_for_dir(self, image_path):
+        """
+        :return:
+            分帧目录对应的已记录视频名，没有记录返回None
+        """
+        name = os.path.basename(image_path.rstrip("/"))
+        for file_name in os.listdir(self.manifest_dir):
+            if file_name.endswith(".json") and file_name[:-5][:-4] == name and self.entry(file_name[:-5]):
+                return file_name[:-5]
+        return None
+
+    def ocr_done(self, video_name):
+        """
+        :return:
+            已经识别过的帧名集合，写到一半的最后一行不算
+        """
+        journal_path = self.journal_path(video_name)
+        if not os.path.exists(journal_path):
+            return set()
+        with open(journal_path, "r") as f:
+            return set(line[:-1] for line in f if line.endswith("\n"))
+
+    def record_ocr(self, video_name, images):
+        """
+        :param:
+            images：本批已识别并写入data文件的帧名
+        """
+        if not images:
+            return
+        with self.lock:
+            with open(self.journal_path(video_name), "a") as f:
+                f.write("".join(image + "\n" for image in images))
+
+    def reset_ocr(self, video_name):
+        with self.lock:
+            if os.path.exists(self.journal_path(video_name)):
+                os.remove(self.journal_path(video_name))
+
+
+class RawFrame:
+    """
+    ffmpeg从stdout输出的一帧rgb24原始像素
+    """
+
+    def __init__(self, index, width, height, data):
+        self.index = index
+        self.width = width
+        self.height = height
+        self.data = data
+
+    @property
+    def name(self):
+        # 与image2输出的%05d.png保持同样的编号和命名
+        return "%05d.png" % self.index
+
+    def to_ppm(self):
+        return b"P6\n%d %d\n255\n" % (self.width, self.height) + self.data
+
+
+class RegionOfInterest:
+    """
+    性能数据浮层所在的固定区域，分帧时由ffmpeg直接裁剪
+    """
+
+    def __init__(self, x, y, width, height):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    def ffmpeg_filter(self):
+        return "crop=%d:%d:%d:%d" % (self.width, self.height, self.x, self.y)
+
+
+class FrameChangeDetector:
+    """
+    判断相邻帧是否有变化，没变化的帧直接沿用上一次的识别结果
+    threshold为0时按像素内容精确比较，大于0时用8x8均值哈希，汉明距离不超过threshold视为相同
+    """
+
+    HASH_SIZE = 8
+
+    def __init__(self, threshold=0):
+        self.threshold = threshold
+
+    def fingerprint(self, source):
+        """
+        :param:
+            source：RawFrame或者图片文件路径
+        """
+        if self.threshold == 0:
+            if isinstance(source, RawFrame):
+                return hashlib.blake2b(source.data, digest_size=16).digest()
+            with open(source, "rb") as f:
+                return hashlib.blake2b(f.read(), digest_size=16).digest()
+        if isinstance(source, RawFrame):
+            return self.average_hash(source)
+        from PIL import Image
+        image = Image.open(source).convert("L").resize((self.HASH_SIZE, self.HASH_SIZE))
+        pixels = list(image.getdata())
+        return self._bits(pixels)
+
+    def average_hash(self, frame, samples=4):
+        """
+        不依赖PIL，每个格子只抽样samples*samples个像素的绿色通道
+        """
+        size = self.HASH_SIZE
+        cells = []
+        for row in range(size):
+            for col in range(size):
+                total = 0
+                for i in range(samples):
+                    y = (row * samples + i) * frame.height // (size * samples)
+                    for j in range(samples):
+                        x = (col * samples + j) * frame.width // (size * samples)
+                        total += frame.data[(y * frame.width + x) * 3 + 1]
+                cells.append(total)
+        return self._bits(cells)
+
+    @staticmethod
+    def _bits(values):
+        mean = sum(values) / len(values)
+        bits = 0
+        for value in values:
+            bits = (bits << 1) | (value > mean)
+        return bits
+
+    def same(self, a, b):
+        if self.threshold == 0:
+            return a == b
+        return bin(a ^ b).count("1") <= self.threshold
+
+    def changed_flags(self, sources):
+        """
+        :return:
+            按顺序产出每帧是否需要重新识别，与上一次识别的帧相比
+        """
+        leader = None
+        for source in sources:
+            fingerprint = self.fingerprint(source)
+            if leader is not None and self.same(leader, fingerprint):
+                yield False
+            else:
+                leader = fingerprint
+                yield True
+
+
+class SamplingPolicy:
+    """
+    分帧采样策略
+        fixed：固定帧率
+        keyframes：只取关键帧
+        scene：画面变化超过阈值时取帧
+    max_frames限制每个视频最多取多少帧
+    """
+
+    FIXED = "fixed"
+    KEYFRAMES = "keyframes"
+    SCENE = "scene"
+
+    def __init__(self, mode=FIXED, fps=1, scene_threshold=0.3, max_frames=None):
+        self.mode = mode
+        self.fps = fps
+        self.scene_threshold = scene_threshold
+        self.max_frames = max_frames
+
+    @classmethod
+    def fixed(cls, fps=1, max_frames=None):
+        return cls(cls.FIXED, fps=fps, max_frames=max_frames)
+
+    @classmethod
+    def keyframes(cls, max_frames=None):
+        return cls(cls.KEYFRAMES, max_frames=max_frames)
+
+    @classmethod
+    def scene_change(cls, threshold=0.3, max_frames=None):
+        return cls(cls.SCENE, scene_threshold=threshold, max_frames=max_frames)
+
+    def describe(self):
+        """
+        :return:
+            {"mode", "fps"}，只有fixed模式有固定帧率，其余fps为None
+        """
+        return {"mode": self.mode, "fps": self.fps if self.mode == self.FIXED else None}
+
+    def input_args(self):
+        if self.mode == self.KEYFRAMES:
+            return ["-skip_frame", "nokey"]
+        return []
+
+    def output_args(self, roi=None):
+        filters = []
+        # 先裁剪再select，场景变化分数只按浮层区域计算，浮层里的小变化也能超过阈值
+        if roi is not None:
+            filters.append(roi.ffmpeg_filter())
+        if self.mode == self.SCENE:
+            filters.append("select='gt(scene,%0.6f)'" % self.scene_threshold)
+        args = []
+        if self.mode == self.FIXED:
+            args += ["-r", "%0.12f" % self.fps]
+        if filters:
+            args += ["-vf", ",".join(filters)]
+        if self.mode != self.FIXED:
+            args += ["-vsync", "vfr"]
+        if self.max_frames:
+            args += ["-frames:v", str(self.max_frames)]
+        return args
+
+
+class AdaptiveSampling:
+    """
+    按视频时长选择帧率：长时间的稳定性录屏稀疏采样，短的复现视频密集采样，
+    每个视频的帧数大致控制在max_frames以内
+    """
+
+    def __init__(self, max_frames=600, min_fps=0.05, max_fps=5):
+        self.max_frames = max_frames
+        self.min_fps = min_fps
+        self.max_fps = max_fps
+
+    def policy_for(self, video_file_path, runner=default_runner):
+        duration = probe_video_duration(video_file_path, runner)
+        fps = self.max_fps if duration <= 0 else self.max_frames / duration
+        fps = min(self.max_fps, max(self.min_fps, fps))
+        return SamplingPolicy.fixed(fps, max_frames=self.max_frames)
+
+
+SAMPLING_FILE = "sampling.json"
+
+
+def write_sampling_info(directory, policy):
+    """
+    把实际使用的采样策略记在data文件所在目录，按秒分窗时据此把帧号换算成时间
+    """
+    with open(os.path.join(directory, SAMPLING_FILE), "w") as f:
+        json.dump(policy.describe(), f)
+
+
+def read_sampling_info(directory):
+    """
+    :return:
+        write_sampling_info记下的dict，没有记录返回None
+    """
+    sampling_path = os.path.join(directory, SAMPLING_FILE)
+    if not os.path.exists(sampling_path):
+        return None
+    with open(sampling_path, "r") as f:
+        return json.load(f)
+
+
+def probe_video_duration(video_file_path, runner=default_runner):
+    """
+    :return:
+        视频时长（秒），取不到时返回0
+    """
+    p = runner.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0",
+                    video_file_path], label=video_file_path)
+    try:
+        return float(p.stdout.decode().strip())
+    except ValueError:
+        return 0
+
+
+def probe_video_size(video_file_path, runner=default_runner):
+    """
+    :return:
+        (width, height)
+    """
+    p = runner.run(["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height",
+                    "-of", "csv=p=0:s=x", video_file_path], label=video_file_path).check()
+    width, height = p.stdout.decode().strip().split("x")[:2]
+    return int(width), int(height)
 
 
 class VideoProcessUtil:
-    def videoToJPG(self, video_path):
+    def __init__(self, max_workers=None, manifest=None, roi=None, sampling=None, runner=None, timeout=None):
+        """
+        :param:
+            max_workers：同时运行的ffmpeg进程数上限，默认为CPU核数
+            manifest：PipelineManifest，传入时跳过哈希未变的视频
+            roi：RegionOfInterest，传入时只保留该区域
+            sampling：SamplingPolicy或AdaptiveSampling，默认每秒1帧
+            runner：CommandRunner，记录每个视频的ffmpeg耗时
+            timeout：单个视频分帧的超时时间（秒）
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.manifest = manifest
+        self.roi = roi
+        self.sampling = sampling or SamplingPolicy.fixed(1)
+        self.runner = runner or default_runner
+        self.timeout = timeout
+
+    def sampling_policy(self, video_file_path):
+        if isinstance(self.sampling, SamplingPolicy):
+            return self.sampling
+        return self.sampling.policy_for(video_file_path, self.runner)
+
+    def sampling_args(self, video_file_path, policy=None):
+        """
+        :param:
+            policy：已经选好的SamplingPolicy，不传则按视频选择
+        :return:
+            (输入参数, 输出参数)
+        """
+        policy = policy or self.sampling_policy(video_file_path)
+        return policy.input_args(), policy.output_args(self.roi)
+
+    def list_videos(self, video_path):
+        video_name_list = os.listdir(video_path)
+        return [name for name in video_name_list if name.endswith(".mp4") or name.endswith(".MP4")]
+
+    def prepare_dir(self, jpg_dir_path):
+        if os.path.exists(jpg_dir_path):
+            shutil.rmtree(jpg_dir_path)
+        os.mkdir(jpg_dir_path)
+
+    def ffmpeg_command(self, video_file_path, jpg_dir_path, sampling_args=None):
+        """
+        :param:
+            sampling_args：已经算好的sampling_args()结果，避免AdaptiveSampling重复调用ffprobe
+        """
+        input_args, output_args = sampling_args or self.sampling_args(video_file_path)
+        return (["ffmpeg", "-v", "error"] + input_args + ["-i", video_file_path] + output_args
+                + ["-f", "image2", jpg_dir_path + "/%05d.png"])
+
+    def ffmpeg_raw_command(self, video_file_path, sampling_args=None):
+        input_args, output_args = sampling_args or self.sampling_args(video_file_path)
+        return (["ffmpeg", "-v", "error"] + input_args + ["-i", video_file_path] + output_args
+                + ["-f", "rawvideo", "-pix_fmt", "rgb24", "-"])
+
+    def iter_raw_frames(self, video_file_path, persist_dir=None, policy=None):
+        """
+        直接从ffmpeg的stdout读取原始帧，不落盘
+        :param:
+            video_file_path：视频文件路径
+            persist_dir：调试用，传入时同时把每帧保存为%05d.ppm
+            policy：已经选好的SamplingPolicy，调用方需要记录采样策略时传入
+        :return:
+            按顺序产出RawFrame
+        """
+        if self.roi is not None:
+            width, height = self.roi.width, self.roi.height
+        else:
+            width, height = probe_video_size(video_file_path, self.runner)
+        frame_size = width * height * 3
+        # 计时器到点杀掉ffmpeg，卡住的read随之返回，结果标记为超时
+        p = self.runner.start(self.ffmpeg_raw_command(video_file_path, self.sampling_args(video_file_path, policy)),
+                              label=video_file_path, stdout=subprocess.PIPE,
+                              timeout=self.timeout)
+        finished = False
+        try:
+            index = 0
+            while True:
+                data = p.stdout.read(frame_size)
+                if len(data) < frame_size:
+                    break
+                index += 1
+                frame = RawFrame(index, width, height, data)
+                if persist_dir is not None:
+                    with open(persist_dir + "/%05d.ppm" % index, "wb") as f:
+                        f.write(frame.to_ppm())
+                yield frame
+            finished = True
+        finally:
+            if not finished:
+                # 调用方提前停止（break、close或者下游出错），不再需要后面的帧
+                p.kill()
+            result = p.wait()
+        if not result.ok:
+            raise CommandError(result)
+
+    def extract_video(self, video_path, video_name):
+        """
+        :param:
+            video_path：视频所在目录
+            video_name：视频文件名
+        :return:
+            该视频分帧后的图片路径
+        """
+        jpg_dir_path = video_path + "/" + video_name[:-4]
+        policy = self.sampling_policy(video_path + "/" + video_name)
+        sampling_args = self.sampling_args(video_path + "/" + video_name, policy)
+        if self.manifest is not None:
+            video_hash, st = self.manifest.video_signature(video_path + "/" + video_name, video_name)
+            sampling = " ".join(sum(sampling_args, []))
+            if self.manifest.is_extracted(video_name, video_hash, jpg_dir_path, sampling):
+                return jpg_dir_path
+        self.prepare_dir(jpg_dir_path)
+        result = self.runner.run(self.ffmpeg_command(video_path + "/" + video_name, jpg_dir_path, sampling_args),
+                                 timeout=self.timeout, label=video_name, capture_stdout=False)
+        if not result.ok:
+            # 分帧失败不记入清单，下次运行会重试
+            print(CommandError(result))
+            if self.manifest is not None:
+                self.manifest.forget_video(video_name)
+            return jpg_dir_path
+        write_sampling_info(jpg_dir_path, policy)
+        if self.manifest is not None:
+            self.manifest.record_video(video_name, video_hash, st, list_frame_images(jpg_dir_path), sampling)
+        return jpg_dir_path
+
+    def iter_videoToJPG(self, video_path, callback=None):
+        """
+        并发分帧，每个视频处理完成后立即产出
+        :param:
+            video_path：分帧的视频路径
+            callback：单个视频完成时的回调，参数为(video_name, jpg_dir_path)
+        :return:
+            按完成顺序产出(video_name, jpg_dir_path)
+        """
+        video_name_list = self.list_videos(video_path)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.extract_video, video_path, name): name for name in video_name_list}
+            for future in as_completed(futures):
+                video_name = futures[future]
+                jpg_dir_path = future.result()
+                if callback is not None:
+                    callback(video_name, jpg_dir_path)
+                yield video_name, jpg_dir_path
+
+    def videoToJPG(self, video_path, callback=None):
         """
         :param:
             video_path：分帧的视频路径
+            callback：单个视频完成时的回调，参数为(video_name, jpg_dir_path)
         :return:
             同路径下生成分帧后的图片路径
         """
-        video_name_list = os.listdir(video_path)
-        video_name_list = [name for name in video_name_list if name.endswith(".mp4") or name.endswith(".MP4")]
-        image_dir_list = []
-        for video_name in video_name_list:
-            jpg_dir_path = video_path + "/" + video_name[:-4]
-            if not os.path.exists(jpg_dir_path):
-                os.mkdir(jpg_dir_path)
-            else:
-                os.system("rm -rf %s " % jpg_dir_path)
-                os.mkdir(jpg_dir_path)
-            os.system(
-                "ffmpeg -i %s -r %0.12f -f image2 %s" % (video_path + "/" + video_name, 1, jpg_dir_path) + "/%05d.png")
-            image_dir_list.append(jpg_dir_path)
-        return image_dir_list
+        video_name_list = self.list_videos(video_path)
+        if self.max_workers <= 1:
+            image_dir_list = []
+            for video_name in video_name_list:
+                jpg_dir_path = self.extract_video(video_path, video_name)
+                if callback is not None:
+                    callback(video_name, jpg_dir_path)
+                image_dir_list.append(jpg_dir_path)
+            return image_dir_list
+        done = dict(self.iter_videoToJPG(video_path, callback))
+        return [done[name] for name in video_name_list if name in done]
+
+
+class TesseractCLIBackend:
+    """
+    调用tesseract命令行识别图片，结果从stdout读回，不经过tmp.txt
+    """
+
+    def __init__(self, lang=None, timeout=60, runner=None):
+        self.lang = lang
+        self.timeout = timeout
+        self.runner = runner or default_runner
+
+    def _run(self, source, label, input=None):
+        args = ["tesseract", source, "stdout"]
+        if self.lang:
+            args += ["-l", self.lang]
+        # 崩溃或超时直接抛出CommandError，不当成"没有MB行"，断点记录里也就不会记下这一帧
+        p = self.runner.run(args, input=input, timeout=self.timeout, label=label).check()
+        return p.stdout.decode("utf-8", "ignore")
+
+    def image_to_string(self, image_file_path):
+        return self._run(image_file_path, image_file_path)
+
+    def frame_to_string(self, frame):
+        return self._run("stdin", frame.name, frame.to_ppm())
+
+
+class TesserocrBackend:
+    """
+    基于tesserocr的进程内识别，引擎只初始化一次，之后每帧复用
+    """
+
+    def __init__(self, lang="eng"):
+        import tesserocr
+        self.api = tesserocr.PyTessBaseAPI(lang=lang)
+
+    def image_to_string(self, image_file_path):
+        self.api.SetImageFile(image_file_path)
+        return self.api.GetUTF8Text()
+
+    def frame_to_string(self, frame):
+        self.api.SetImageBytes(frame.data, frame.width, frame.height, 3, frame.width * 3)
+        return self.api.GetUTF8Text()
+
+
+def default_ocr_backend():
+    try:
+        return TesserocrBackend()
+    except ImportError:
+        return TesseractCLIBackend()
+
+
+def pick_mb_line(text):
+    """
+    :return:
+        识别结果中第一行包含"MB"的文本，没有则返回None
+    """
+    for line in text.splitlines(True):
+        if "MB" in line:
+            return line if line.endswith("\n") else line + "\n"
+    return None
+
+
+_worker_backend = None
+
+
+def _init_ocr_worker(backend_factory):
+    global _worker_backend
+    _worker_backend = backend_factory()
+
+
+def _ocr_in_worker(image_file_path):
+    return os.path.basename(image_file_path), _worker_backend.image_to_string(image_file_path)
+
+
+def _ocr_frame_in_worker(frame):
+    return frame.name, _worker_backend.frame_to_string(frame)
+
+
+def bounded_map(executor, fn, iterable, max_inflight):
+    """
+    与executor.map相同按输入顺序返回，但同时提交的任务不超过max_inflight，
+    避免把整段视频的帧一次性塞进内存
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_inflight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class OCRWorkerPool:
+    """
+    常驻的OCR进程池，每个进程启动时创建一次backend，之后所有帧复用
+    """
+
+    def __init__(self, backend_factory=default_ocr_backend, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=self.processes,
+                                            initializer=_init_ocr_worker, initargs=(backend_factory,))
+
+    def map(self, image_file_list, chunksize=4):
+        """
+        :return:
+            按输入顺序产出(图片文件名, 识别文本)
+        """
+        return self.executor.map(_ocr_in_worker, image_file_list, chunksize=chunksize)
+
+    def map_frames(self, frames):
+        """
+        :param:
+            frames：RawFrame的迭代器，可以边解码边识别
+        :return:
+            按输入顺序产出(帧文件名, 识别文本)
+        """
+        return bounded_map(self.executor, _ocr_frame_in_worker, frames, self.processes * 2)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DataFileWriter:
+    """
+    写data文件的同时写一个data.frames旁路文件，每行记录对应data行来自哪一帧，
+    data文件本身格式不变
+    """
+
+    def __init__(self, result_path, append=False):
+        mode = "a" if append else "w"
+        self.result_file = open(result_path, mode)
+        self.frames_file = open(result_path + ".frames", mode)
+
+    def write(self, image, line):
+        if line is None:
+            return
+        self.result_file.write(line)
+        self.frames_file.write(image + "\n")
+
+    def flush(self):
+        self.result_file.flush()
+        self.frames_file.flush()
+
+    def close(self):
+        self.result_file.close()
+        self.frames_file.close()
+
+    @staticmethod
+    def keep_frames(result_path, frames):
+        """
+        只保留来自frames中各帧的data行，用于断点续跑前去掉识别进度里没有记录的行
+        """
+        if not os.path.exists(result_path) or not os.path.exists(result_path + ".frames"):
+            return
+        with open(result_path, "r") as f, open(result_path + ".frames", "r") as frames_file:
+            lines = f.readlines()
+            images = frames_file.readlines()
+        # 中断时两个文件可能差一行，或者最后一行没写完
+        pairs = [(image, line) for image, line in zip(images, lines) if image.endswith("\n") and line.endswith("\n")]
+        kept = [(image, line) for image, line in pairs if image.strip() in frames]
+        if len(kept) == len(lines) == len(images):
+            return
+        with DataFileWriter(result_path) as writer:
+            for image, line in kept:
+                writer.write(image.strip(), line)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 class ImageProcessUtil:
+    def __init__(self, pool=None, manifest=None, detector=None, video_util=None):
+        """
+        :param:
+            pool：OCRWorkerPool，不传则每次调用时临时创建
+            manifest：PipelineManifest，传入时只识别还没识别过的帧
+            detector：FrameChangeDetector，传入时与上一帧相同的帧不再识别
+            video_util：VideoProcessUtil，内存模式分帧时使用它的ROI、采样策略、runner和超时
+        """
+        self.pool = pool
+        self.manifest = manifest
+        self.detector = detector
+        self.video_util = video_util or VideoProcessUtil()
+
+    def list_images(self, image_path):
+        return list_frame_images(image_path)
+
+    def ocr_images(self, image_path, image_list=None):
+        """
+        :return:
+            按文件名顺序产出(图片文件名, 包含"MB"的那一行)
+        """
+        if image_list is None:
+            image_list = self.list_images(image_path)
+        image_file_list = [image_path + "/" + image for image in image_list]
+        if self.detector is None:
+            flags = [True] * len(image_file_list)
+        else:
+            flags = list(self.detector.changed_flags(image_file_list))
+        pool = self.pool or OCRWorkerPool()
+        try:
+            results = pool.map([path for path, flag in zip(image_file_list, flags) if flag])
+            line = None
+            for image, flag in zip(image_list, flags):
+                if flag:
+                    line = pick_mb_line(next(results)[1])
+                yield image, line
+        finally:
+            if pool is not self.pool:
+                pool.close()
+
     def process_image_data(self, image_path, result_path):
-        image_list = os.listdir(image_path)
-        for image in image_list:
-            image_file_path = image_path + "/" + image
-            print(image_file_path)
-
-            os.system("tesseract " + image_file_path + " tmp")
-            with open(image_path + "/data", "a+") as result_file:
-                with open("tmp.txt", "r") as f:
-                    lines = f.readlines()
-                    for line in lines:
-                        if "MB" in line:
-                            result_file.write(line)
-                            break;
-                f.close()
-            result_file.close()
+        video_name = self.manifest.video_for_dir(image_path) if self.manifest is not None else None
+        if video_name is None:
+            with DataFileWriter(result_path) as writer:
+                for image, line in self.ocr_images(image_path):
+                    print(image_path + "/" + image)
+                    writer.write(image, line)
+            return
+
+        done = self.manifest.ocr_done(video_name)
+        if not os.path.exists(result_path):
+            # data文件丢了，之前的识别结果也就没了，从头识别
+            self.manifest.reset_ocr(video_name)
+            done = set()
+        # 上次中断时已写进data但还没记入进度的行去掉，这些帧会重新识别
+        DataFileWriter.keep_frames(result_path, done)
+        # 帧总是按文件名顺序识别，已识别的是前缀，续写的结果仍按帧顺序追加在后面
+        todo = [image for image in self.list_images(image_path) if image not in done]
+        batch = []
+        with DataFileWriter(result_path, append=True) as writer:
+            for image, line in self.ocr_images(image_path, todo):
+                print(image_path + "/" + image)
+                writer.write(image, line)
+                batch.append(image)
+                if len(batch) >= 100:
+                    writer.flush()
+                    self.manifest.record_ocr(video_name, batch)
+                    batch = []
+            writer.flush()
+            self.manifest.record_ocr(video_name, batch)
+
+    def process_video_in_memory(self, video_file_path, result_path, persist_dir=None):
+        """
+        视频帧经内存直接送去识别，不写出png
+        :param:
+            persist_dir：调试用，传入时同时把帧保存到该目录
+        """
+        policy = self.video_util.sampling_policy(video_file_path)
+        write_sampling_info(os.path.dirname(os.path.abspath(result_path)), policy)
+        frames = self.video_util.iter_raw_frames(video_file_path, persist_dir, policy)
+        order = collections.deque()
+
+        def changed_frames():
+            if self.detector is None:
+                for frame in frames:
+                    order.append(frame.name)
+                    yield frame
+                return
+            leader = None
+            for frame in frames:
+                fingerprint = self.detector.fingerprint(frame)
+                order.append(frame.name)
+                if leader is None or not self.detector.same(leader, fingerprint):
+                    leader = fingerprint
+                    yield frame
+
+        pool = self.pool or OCRWorkerPool()
+        try:
+            with DataFileWriter(result_path) as writer:
+                line = None
+                for image, text in pool.map_frames(changed_frames()):
+                    # 排在这一帧之前的都是上一个识别帧的重复帧
+                    while order[0] != image:
+                        writer.write(order.popleft(), line)
+                    order.popleft()
+                    line = pick_mb_line(text)
+                    writer.write(image, line)
+                while order:
+                    writer.write(order.popleft(), line)
+        finally:
+            # 提前退出时关闭生成器，结束ffmpeg
+            frames.close()
+            if pool is not self.pool:
+                pool.close()
+
+
+NUMBER_RE = re.compile(r"\d+\.?\d*")
+
+
+def fix_decimal(value):
+    """
+    OCR经常丢掉小数点，没有小数点的数按缩小10倍处理
+    """
+    if "." not in value:
+        return float(value) / 10
+    return float(value)
+
+
+def split_perf_line(data):
+    """
+    单次正则扫描拆出一行性能数据的原始字段
+    :return:
+        (cpu, mem, gpu)三个数字字符串，解析失败返回None
+    """
+    first = data.find("%")
+    second = data.find("%", first + 1) if first >= 0 else -1
+    cpu = mem = gpu = None
+    for match in NUMBER_RE.finditer(data):
+        start = match.start()
+        if cpu is None and (first < 0 or start < first):
+            cpu = match.group()
+        elif mem is None and first >= 0 and start > first and (second < 0 or start < second):
+            mem = match.group()
+        gpu = match.group()
+    if cpu is None or mem is None:
+        return None
+    return cpu, mem, gpu
+
+
+def parse_perf_line(data):
+    """
+    :return:
+        (cpu, mem, gpu)，解析失败返回None
+    """
+    fields = split_perf_line(data)
+    if fields is None:
+        return None
+    return fix_decimal(fields[0]), fix_decimal(fields[1]), fix_decimal(fields[2])
+
+
+PERCENTILES = (50, 95, 99)
+
+
+class QuantileSketch:
+    """
+    对数分桶的分位数草图，相对误差不超过accuracy，两个草图可以直接合并
+    """
+
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError("cannot merge sketches with different accuracy")
+        self.count += other.count
+        self.zeros += other.zeros
+        for key, n in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + n
+        return self
+
+    def value_at(self, index):
+        """
+        :return:
+            从小到大第index个值（从0开始）的估计，取所在桶的中点
+        """
+        seen = self.zeros
+        if index < seen:
+            return 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if index < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def quantile(self, q):
+        """
+        与numpy.percentile默认的linear方法相同：秩为q/100*(n-1)，落在两个值之间时线性插值，
+        这样小窗口里的单个尖峰也能体现在p95/p99上，结果与PerfColumns一致
+        :param:
+            q：0~100
+        """
+        if not self.count:
+            return 0
+        rank = q / 100 * (self.count - 1)
+        lower = math.floor(rank)
+        value = self.value_at(lower)
+        if rank > lower:
+            value += (rank - lower) * (self.value_at(lower + 1) - value)
+        return value
+
+
+class MetricStats:
+    def __init__(self, with_sketch=False):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.sketch = QuantileSketch() if with_sketch else None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.sketch is not None:
+            self.sketch.add(value)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+        return self
+
+    def quantile(self, q):
+        # 草图按桶中点估计，不能超过实际的最大值
+        return min(self.sketch.quantile(q), self.max)
+
+    def to_dict(self, lines):
+        result = {"count": self.count, "avg": self.total / lines if lines else 0, "max": self.max}
+        if self.sketch is not None:
+            for q in PERCENTILES:
+                result["p%d" % q] = self.quantile(q)
+        return result
+
+
+class PerfStats:
+    """
+    cpu/mem/gpu的增量统计，平均值按总行数计算，与process_data保持一致
+    with_sketch为True时同时记录分位数草图，多个文件的统计可以用merge合并
+    """
+
+    def __init__(self, with_sketch=False):
+        self.lines = 0
+        self.cpu = MetricStats(with_sketch)
+        self.mem = MetricStats(with_sketch)
+        self.gpu = MetricStats(with_sketch)
+
+    def merge(self, other):
+        self.lines += other.lines
+        self.cpu.merge(other.cpu)
+        self.mem.merge(other.mem)
+        self.gpu.merge(other.gpu)
+        return self
+
+    def add_line(self, data):
+        self.lines += 1
+        values = parse_perf_line(data)
+        if values is None:
+            print(data)
+            return False
+        self.add(*values)
+        return True
+
+    def add(self, cpu, mem, gpu):
+        self.cpu.add(cpu)
+        self.mem.add(mem)
+        self.gpu.add(gpu)
+
+    def average(self, metric):
+        return metric.total / self.lines if self.lines else 0
+
+    def to_dict(self, name):
+        """
+        :return:
+            {"name": name, "lines": 总行数, "cpu": {...}, "mem": {...}, "gpu": {...}}
+            每个指标包含count/avg/max，有草图时还有p50/p95/p99
+        """
+        return {
+            "name": name,
+            "lines": self.lines,
+            "cpu": self.cpu.to_dict(self.lines),
+            "mem": self.mem.to_dict(self.lines),
+            "gpu": self.gpu.to_dict(self.lines),
+        }
+
+    def report(self, file_path):
+        result = ""
+        result += file_path + " avr cpu is " + str(self.average(self.cpu)) + "\n"
+        result += file_path + " max cpu is " + str(self.cpu.max) + "\n"
+        result += file_path + " avr mem is " + str(self.average(self.mem)) + "\n"
+        result += file_path + " max mem is " + str(self.mem.max) + "\n"
+        result += file_path + " avr gpu is " + str(self.average(self.gpu)) + "\n"
+        result += file_path + " max gpu is " + str(self.gpu.max) + "\n"
+        for name in ("cpu", "mem", "gpu"):
+            metric = getattr(self, name)
+            if metric.sketch is None:
+                continue
+            for q in PERCENTILES:
+                result += file_path + " p%d %s is " % (q, name) + str(metric.quantile(q)) + "\n"
+        return result
+
+
+def summarize_file(file_path):
+    return PerformanceDataProcess().summarize(file_path, with_sketch=True)
+
+
+def device_of(file_path):
+    """
+    data文件位于 设备目录/视频名/data，默认按设备目录名汇总
+    """
+    return os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(file_path))))
+
+
+def summarize_files(file_path_list, processes=None, group_key=device_of):
+    """
+    多进程并行统计多个data文件，一次得到单文件、分组和整体三个层级的结果
+    :return:
+        ({文件: PerfStats}, {分组: PerfStats}, 整体PerfStats)
+    """
+    per_file = {}
+    per_group = {}
+    total = PerfStats(with_sketch=True)
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count() or 1) as executor:
+        for file_path, stats in zip(file_path_list, executor.map(summarize_file, file_path_list)):
+            per_file[file_path] = stats
+            per_group.setdefault(group_key(file_path), PerfStats(with_sketch=True)).merge(stats)
+            total.merge(stats)
+    return per_file, per_group, total
+
+
+NUMBER_BYTES_RE = re.compile(rb"\d+\.?\d*")
+
+
+def _fix_decimal_bytes(value):
+    if b"." not in value:
+        return float(value) / 10
+    return float(value)
+
+
+def scan_mapped_range(buf, start, end, stats):
+    """
+    直接在映射的缓冲区上按行扫描[start, end)，不为每行构造str对象
+    解析规则与split_perf_line相同
+    """
+    pos = start
+    while pos < end:
+        nl = buf.find(b"\n", pos, end)
+        if nl < 0:
+            nl = end
+        stats.lines += 1
+        first = buf.find(b"%", pos, nl)
+        second = buf.find(b"%", first + 1, nl) if first >= 0 else -1
+        cpu = mem = gpu = None
+        for match in NUMBER_BYTES_RE.finditer(buf, pos, nl):
+            match_start = match.start()
+            if cpu is None and (first < 0 or match_start < first):
+                cpu = match.group()
+            elif mem is None and first >= 0 and match_start > first and (second < 0 or match_start < second):
+                mem = match.group()
+            gpu = match.group()
+        if cpu is None or mem is None:
+            print(buf[pos:nl + 1].decode("utf-8", "ignore"))
+        else:
+            stats.add(_fix_decimal_bytes(cpu), _fix_decimal_bytes(mem), _fix_decimal_bytes(gpu))
+        pos = nl + 1
+    return stats
+
+
+def split_ranges(file_path, parts):
+    """
+    把文件切成parts段，每段边界对齐到换行符之后
+    :return:
+        [(start, end), ...]
+    """
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return []
+    bounds = [0]
+    with open(file_path, "rb") as f:
+        for i in range(1, parts):
+            f.seek(max(size * i // parts, bounds[-1]))
+            f.readline()
+            position = f.tell()
+            if position >= size:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def summarize_range(file_path, start, end, with_sketch=True):
+    stats = PerfStats(with_sketch)
+    if start >= end:
+        return stats
+    with open(file_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return scan_mapped_range(buf, start, end, stats)
+
+
+def _summarize_range_task(task):
+    return summarize_range(*task)
+
+
+def summarize_mapped(file_path, processes=None, with_sketch=True):
+    """
+    mmap方式统计超大的data文件，按字节区间分给多个进程并行扫描后合并
+    :return:
+        PerfStats
+    """
+    processes = processes or os.cpu_count() or 1
+    ranges = split_ranges(file_path, processes)
+    if len(ranges) <= 1:
+        return summarize_range(file_path, 0, os.path.getsize(file_path), with_sketch)
+    total = PerfStats(with_sketch)
+    tasks = [(file_path, start, end, with_sketch) for start, end in ranges]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for stats in executor.map(_summarize_range_task, tasks):
+            total.merge(stats)
+    return total
+
+
+def frame_index(image):
+    """
+    "00012.png" -> 12
+    """
+    return int(os.path.splitext(os.path.basename(image))[0])
+
+
+def iter_indexed_lines(file_path):
+    """
+    :return:
+        产出(帧序号, data行)，有data.frames旁路文件时用其中的帧号，否则按行号（从1开始）
+    """
+    frames_path = file_path + ".frames"
+    with open(file_path, "r", buffering=1024 * 1024) as f:
+        if not os.path.exists(frames_path):
+            for index, data in enumerate(f, 1):
+                yield index, data
+            return
+        with open(frames_path, "r") as frames:
+            for image, data in zip(frames, f):
+                yield frame_index(image.strip()), data
+
+
+class WindowedAggregator:
+    """
+    按固定长度的窗口汇总：unit为"frames"时每window帧一个窗口，为"seconds"时按采样帧率换算成时间，
+    每个窗口只保留一份PerfStats，窗口结束即产出，内存占用与数据量无关
+    """
+
+    FRAMES = "frames"
+    SECONDS = "seconds"
+
+    def __init__(self, window=60, unit=FRAMES, fps=1, with_sketch=True):
+        """
+        :param:
+            window：窗口长度，单位由unit决定
+            fps：分帧时的采样帧率，用于把帧号换算成秒
+        """
+        self.window = window
+        self.unit = unit
+        self.fps = fps
+        self.with_sketch = with_sketch
+        self.current = None
+        self.stats = None
+        self.first_frame = None
+        self.last_frame = None
+
+    def window_of(self, index):
+        if self.unit == self.SECONDS:
+            return int((index - 1) / self.fps // self.window)
+        return (index - 1) // self.window
+
+    def add(self, index, data):
+        """
+        :return:
+            这一行开启了新窗口时，返回刚结束的窗口记录，否则返回None
+        """
+        window = self.window_of(index)
+        finished = None
+        if window != self.current:
+            finished = self.flush()
+            self.current = window
+            self.stats = PerfStats(self.with_sketch)
+            self.first_frame = index
+        self.last_frame = index
+        self.stats.add_line(data)
+        return finished
+
+    def flush(self):
+        if self.stats is None:
+            return None
+        record = self.stats.to_dict("window %d" % self.current)
+        record["window"] = self.current
+        record["first_frame"] = self.first_frame
+        record["last_frame"] = self.last_frame
+        record["start_seconds"] = (self.first_frame - 1) / self.fps
+        record["end_seconds"] = self.last_frame / self.fps
+        self.stats = None
+        return record
+
+    def run(self, indexed_lines):
+        for index, data in indexed_lines:
+            record = self.add(index, data)
+            if record is not None:
+                yield record
+        record = self.flush()
+        if record is not None:
+            yield record
+
+
+def flatten_record(record):
+    """
+    {"cpu": {"avg": 1}} -> {"cpu_avg": 1}，用于CSV这类扁平格式
+    """
+    flat = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                flat[key + "_" + sub_key] = sub_value
+        else:
+            flat[key] = value
+    return flat
+
+
+class JsonLinesWriter:
+    """
+    每条统计结果写一行JSON，边统计边写，不在内存里攒整批结果
+    """
+
+    def __init__(self, output, newline=None):
+        """
+        :param:
+            output：文件路径或者已打开的文本文件对象
+        """
+        self.own = isinstance(output, str)
+        self.f = open(output, "w", newline=newline) if self.own else output
+
+    def write(self, record):
+        self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        if self.own:
+            self.f.close()
+        else:
+            self.f.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CsvWriter(JsonLinesWriter):
+    """
+    嵌套的统计结果展开成cpu_avg这样的列，表头取第一条记录的字段
+    """
+
+    def __init__(self, output, fields=None):
+        super().__init__(output, newline="")
+        self.fields = fields
+        self.writer = None
+
+    def write(self, record):
+        flat = flatten_record(record)
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.f, fieldnames=self.fields or list(flat), extrasaction="ignore")
+            self.writer.writeheader()
+        self.writer.writerow(flat)
+
+
+def open_record_writer(output_path):
+    """
+    按扩展名选择写出格式：.csv为CSV，其余为JSON Lines
+    """
+    if output_path.lower().endswith(".csv"):
+        return CsvWriter(output_path)
+    return JsonLinesWriter(output_path)
+
+
+def fix_decimal_column(raw):
+    """
+    向量化的小数点修正，raw为数字字符串数组（str或bytes）
+    """
+    values = raw.astype(np.float64)
+    no_point = np.char.find(raw, b"." if raw.dtype.kind == "S" else ".") < 0
+    return np.where(no_point, values / 10, values)
+
+
+# 整行匹配，规则与split_perf_line相同：cpu是第一个%之前的第一个数，mem是第一个和第二个%之间的第一个数，
+# gpu是整行最后一个数（重复分组只保留最后一次匹配）；匹配不上的行落到最后一个分组，按识别失败处理
+PERF_LINE_BYTES_RE = re.compile(
+    rb"^(?:[^\n%\d]*(\d+\.?\d*)[^\n%]*%[^\n%\d]*(\d+\.?\d*)(?:[^\n\d]*(\d+\.?\d*))*[^\n]*|([^\n]*))$",
+    re.M)
+
+
+def parse_perf_chunk(chunk):
+    """
+    用一次findall解析一块完整的行，不为每行调用split_perf_line
+    :return:
+        (行数, cpu数组, mem数组, gpu数组, 识别失败的行（与逐行读取时一样带换行符）)
+    """
+    rows = PERF_LINE_BYTES_RE.findall(chunk)
+    terminated = chunk.endswith(b"\n")
+    if terminated:
+        # 最后一个换行之后的空匹配不是一行
+        rows.pop()
+    if not rows:
+        return 0, np.zeros(0), np.zeros(0), np.zeros(0), []
+    table = np.array(rows, dtype=bytes)
+    parsed = table[:, 0] != b""
+    bad = [line + b"\n" for line in table[~parsed, 3].tolist()]
+    if bad and not terminated and not parsed[-1]:
+        bad[-1] = bad[-1][:-1]
+    cpu, mem, gpu = table[parsed, 0], table[parsed, 1], table[parsed, 2]
+    # 第二个%之后没有数时gpu就是mem
+    gpu = np.where(gpu == b"", mem, gpu)
+    return len(rows), fix_decimal_column(cpu), fix_decimal_column(mem), fix_decimal_column(gpu), bad
+
+
+class PerfColumns:
+    """
+    按列存储的cpu/mem/gpu数据，统计全部用numpy批量计算
+    """
+
+    def __init__(self, lines, cpu, mem, gpu):
+        self.lines = lines
+        self.cpu = cpu
+        self.mem = mem
+        self.gpu = gpu
+
+    @classmethod
+    def load(cls, file_path, chunk_size=4 * 1024 * 1024):
+        """
+        按块读取，每块用parse_perf_chunk整体解析成float数组，只保留数值列
+        """
+        if np is None:
+            raise ImportError("numpy is required for the vectorized backend")
+        lines = 0
+        columns = ([], [], [])
+        rest = b""
+        with open(file_path, "rb") as f:
+            while True:
+                block = f.read(chunk_size)
+                chunk = rest + block
+                if block:
+                    # 最后一个换行之后的半行留到下一块
+                    cut = chunk.rfind(b"\n") + 1
+                    chunk, rest = chunk[:cut], chunk[cut:]
+                if chunk:
+                    count, cpu, mem, gpu, bad = parse_perf_chunk(chunk)
+                    lines += count
+                    for column, values in zip(columns, (cpu, mem, gpu)):
+                        column.append(values)
+                    for data in bad:
+                        print(data.decode("utf-8", "ignore"))
+                if not block:
+                    break
+        return cls(lines, *[np.concatenate(column) if column else np.zeros(0) for column in columns])
+
+    def stats(self, column):
+        """
+        :return:
+            dict，包含avg/mean/max/stddev以及p50/p95/p99
+            avg与process_data一致按总行数计算（识别失败的行算作0）；
+            mean/stddev/分位数只按成功解析的值计算，stddev是相对mean的标准差
+        """
+        if not len(column):
+            result = {"avg": 0, "mean": 0, "max": 0, "stddev": 0}
+            result.update(("p%d" % q, 0) for q in PERCENTILES)
+            return result
+        result = {
+            "avg": float(column.sum()) / self.lines,
+            "mean": float(column.mean()),
+            "max": float(column.max()),
+            "stddev": float(column.std()),
+        }
+        for q, value in zip(PERCENTILES, np.percentile(column, PERCENTILES)):
+            result["p%d" % q] = float(value)
+        return result
+
+    def to_dict(self, name):
+        result = {"name": name, "lines": self.lines}
+        for metric in ("cpu", "mem", "gpu"):
+            column = getattr(self, metric)
+            result[metric] = dict(count=len(column), **self.stats(column))
+        return result
+
+    def report(self, file_path):
+        result = ""
+        for name in ("cpu", "mem", "gpu"):
+            stats = self.stats(getattr(self, name))
+            result += file_path + " avr %s is " % name + str(stats["avg"]) + "\n"
+            result += file_path + " max %s is " % name + str(stats["max"]) + "\n"
+            # 以下几项只统计成功解析的行
+            result += file_path + " mean %s is " % name + str(stats["mean"]) + "\n"
+            for q in PERCENTILES:
+                result += file_path + " p%d %s is " % (q, name) + str(stats["p%d" % q]) + "\n"
+            result += file_path + " stddev %s is " % name + str(stats["stddev"]) + "\n"
+        return result
 
 
 class PerformanceDataProcess:
-    def process_data(self, file_path):
+    def process_data_numpy(self, file_path):
+        """
+        numpy向量化统计，在avg/max之外输出mean、p50/p95/p99和标准差；
+        avg按总行数计算，mean/分位数/标准差只按成功解析的行计算
+        """
+        return PerfColumns.load(file_path).report(file_path)
+
+    def summarize(self, file_path, with_sketch=False, buffering=1024 * 1024):
+        """
+        :return:
+            PerfStats，逐行读取，内存占用与文件大小无关
+        """
+        stats = PerfStats(with_sketch)
+        with open(file_path, "r", buffering=buffering) as f:
+            for data in f:
+                stats.add_line(data)
+        return stats
+
+    def process_data_streaming(self, file_path, buffering=1024 * 1024):
+        """
+        输出与process_data相同
+        """
+        return self.summarize(file_path, buffering=buffering).report(file_path)
+
+    def process_data_mmap(self, file_path, processes=None):
+        """
+        mmap并行扫描，适合几十GB的长时间稳定性测试数据，输出与process_data相同
+        """
+        return summarize_mapped(file_path, processes, with_sketch=False).report(file_path)
+
+    def process_data_windowed(self, file_path, window=60, unit=WindowedAggregator.FRAMES, fps=None):
+        """
+        按窗口输出avg/max/分位数，定位峰值出现在录屏的哪一段
+        :param:
+            fps：按秒分窗时的采样帧率，默认读取分帧时记在同目录sampling.json里的实际帧率，
+                 没有记录时按每秒1帧；keyframes/scene采样没有固定帧率，不能按秒分窗
+        :return:
+            逐个窗口产出dict，可以直接交给JsonLinesWriter/CsvWriter
+        """
+        if unit == WindowedAggregator.SECONDS:
+            fps = self.window_fps(file_path, fps)
+        return WindowedAggregator(window, unit, fps or 1).run(iter_indexed_lines(file_path))
+
+    @staticmethod
+    def window_fps(file_path, fps=None):
+        info = read_sampling_info(os.path.dirname(os.path.abspath(file_path)))
+        if info is None:
+            return fps or 1
+        if info["fps"] is None:
+            raise ValueError("%s was sampled with %s, which has no fixed frame rate; use unit=%r"
+                             % (file_path, info["mode"], WindowedAggregator.FRAMES))
+        if fps is not None and not math.isclose(fps, info["fps"]):
+            raise ValueError("%s was sampled at %s fps, not %s" % (file_path, info["fps"], fps))
+        return info["fps"]
+
+    def process_data_structured(self, file_path, with_sketch=True):
+        """
+        与process_data统计相同，但返回dict，供下游直接使用，不必再解析文本
+        """
+        return self.summarize(file_path, with_sketch).to_dict(file_path)
+
+    def write_records(self, file_path_list, output_path, with_sketch=True):
+        """
+        逐个文件统计并立即写出，适合大批量文件
+        """
+        with open_record_writer(output_path) as writer:
+            for file_path in file_path_list:
+                writer.write(self.process_data_structured(file_path, with_sketch))
+
+    def process_data(self, file_path, streaming=False):
+        if streaming:
+            return self.process_data_streaming(file_path)
         cpu_count = 0
         gpu_count = 0
         mem_count = 0
@@ -99,14 +1773,311 @@ class PerformanceDataProcess:
             return result
 
 
+class StageCounter:
+    """
+    流水线单个阶段的吞吐计数
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds, items=1):
+        with self.lock:
+            self.items += items
+            self.busy_seconds += seconds
+
+    def snapshot(self, elapsed):
+        with self.lock:
+            return {
+                "stage": self.name,
+                "items": self.items,
+                "busy_seconds": self.busy_seconds,
+                "items_per_sec": self.items / elapsed if elapsed else 0,
+            }
+
+
+_PIPELINE_DONE = object()
+
+
+class _DuplicateOf:
+    def __init__(self, leader):
+        self.leader = leader
+
+
+class _PipelineError:
+    """
+    某个阶段的异常，经result_queue交给run()重新抛出
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _PipelineAborted(Exception):
+    """
+    其他阶段已经出错，分帧线程提前结束
+    """
+
+
+class FramePipeline:
+    """
+    分帧 -> 识别 -> 统计 三个阶段通过有界队列串成流水线，
+    第一帧分出来就开始识别，识别结果一到就更新统计
+    """
+
+    def __init__(self, video_util=None, backend_factory=default_ocr_backend, ocr_workers=None,
+                 queue_size=64, keep_frames=True, poll_interval=0.2, in_memory=False, persist_frames=False,
+                 detector=None):
+        """
+        :param:
+            video_util：VideoProcessUtil，决定分帧并发数和ffmpeg命令
+            backend_factory：每个识别线程各自创建一个OCR backend
+            ocr_workers：识别线程数，默认为CPU核数
+            queue_size：阶段之间队列的长度上限
+            keep_frames：为False时图片识别完立即删除，降低磁盘峰值占用
+            in_memory：为True时帧从ffmpeg的stdout直接进入识别队列，不写png
+            persist_frames：in_memory模式下同时把帧保存为ppm，便于调试
+            detector：FrameChangeDetector，与上一识别帧相同的帧直接复用结果
+        """
+        self.video_util = video_util or VideoProcessUtil()
+        self.backend_factory = backend_factory
+        self.ocr_workers = ocr_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.keep_frames = keep_frames
+        self.poll_interval = poll_interval
+        self.in_memory = in_memory
+        self.persist_frames = persist_frames
+        self.detector = detector
+        self.counters = [StageCounter("extract"), StageCounter("ocr"), StageCounter("aggregate"),
+                         StageCounter("ocr_skipped")]
+        self.started = None
+        self.aborted = threading.Event()
+
+    def stage_stats(self):
+        elapsed = time.time() - self.started if self.started else 0
+        return [counter.snapshot(elapsed) for counter in self.counters]
+
+    def _dispatch(self, jpg_dir_path, image, leader, frame_queue, result_queue):
+        """
+        没有变化的帧不进识别队列，直接标记为leader["name"]的重复帧交给统计阶段
+        """
+        if self.aborted.is_set():
+            raise _PipelineAborted()
+        if self.detector is not None:
+            is_frame = isinstance(image, RawFrame)
+            name = image.name if is_frame else image
+            fingerprint = self.detector.fingerprint(image if is_frame else jpg_dir_path + "/" + image)
+            if leader and self.detector.same(leader["fingerprint"], fingerprint):
+                self.counters[3].record(0)
+                if not is_frame and not self.keep_frames:
+                    os.remove(jpg_dir_path + "/" + image)
+                result_queue.put((jpg_dir_path, name, _DuplicateOf(leader["name"])))
+                return
+            leader.update(fingerprint=fingerprint, name=name)
+        frame_queue.put((jpg_dir_path, image))
+
+    def _emit_frames(self, jpg_dir_path, emitted, leader, frame_queue, result_queue, finished):
+        names = list_frame_images(jpg_dir_path)
+        # ffmpeg还在写的最后一帧可能不完整，进程结束前只交出已有后继的帧
+        ready = names if finished else names[:-1]
+        for name in ready:
+            if name not in emitted:
+                emitted.add(name)
+                self._dispatch(jpg_dir_path, name, leader, frame_queue, result_queue)
+
+    def _extract_in_memory(self, video_path, video_name, frame_queue, result_queue):
+        jpg_dir_path = video_path + "/" + video_name[:-4]
+        self.video_util.prepare_dir(jpg_dir_path)
+        persist_dir = jpg_dir_path if self.persist_frames else None
+        policy = self.video_util.sampling_policy(video_path + "/" + video_name)
+        write_sampling_info(jpg_dir_path, policy)
+        leader = {}
+        begin = time.time()
+        for frame in self.video_util.iter_raw_frames(video_path + "/" + video_name, persist_dir, policy):
+            self.counters[0].record(time.time() - begin)
+            self._dispatch(jpg_dir_path, frame, leader, frame_queue, result_queue)
+            begin = time.time()
+        return jpg_dir_path
+
+    def _extract(self, video_path, video_name, frame_queue, result_queue):
+        if self.in_memory:
+            return self._extract_in_memory(video_path, video_name, frame_queue, result_queue)
+        jpg_dir_path = video_path + "/" + video_name[:-4]
+        self.video_util.prepare_dir(jpg_dir_path)
+        begin = time.time()
+        policy = self.video_util.sampling_policy(video_path + "/" + video_name)
+        write_sampling_info(jpg_dir_path, policy)
+        command = self.video_util.ffmpeg_command(video_path + "/" + video_name, jpg_dir_path,
+                                                 self.video_util.sampling_args(video_path + "/" + video_name, policy))
+        p = self.video_util.runner.start(command, label=video_name, timeout=self.video_util.timeout)
+        emitted = set()
+        leader = {}
+        try:
+            while p.poll() is None:
+                self._emit_frames(jpg_dir_path, emitted, leader, frame_queue, result_queue, False)
+                time.sleep(self.poll_interval)
+        except BaseException:
+            p.kill()
+            p.wait()
+            raise
+        result = p.wait()
+        if not result.ok:
+            # 与in_memory模式一致，分帧失败由run()抛出，不再交出可能不完整的帧
+            raise CommandError(result)
+        self._emit_frames(jpg_dir_path, emitted, leader, frame_queue, result_queue, True)
+        self.counters[0].record(time.time() - begin, len(emitted))
+        return jpg_dir_path
+
+    def _ocr(self, frame_queue, result_queue):
+        """
+        出错时把异常交给run()，并继续取走队列里的帧直到结束标记，避免分帧线程卡在满队列上；
+        无论如何最后都会发出_PIPELINE_DONE
+        """
+        try:
+            backend = self.backend_factory()
+            while True:
+                item = frame_queue.get()
+                if item is _PIPELINE_DONE:
+                    return
+                if self.aborted.is_set():
+                    continue
+                jpg_dir_path, image = item
+                begin = time.time()
+                if isinstance(image, RawFrame):
+                    line = pick_mb_line(backend.frame_to_string(image))
+                    image = image.name
+                else:
+                    image_file_path = jpg_dir_path + "/" + image
+                    line = pick_mb_line(backend.image_to_string(image_file_path))
+                    if not self.keep_frames:
+                        os.remove(image_file_path)
+                self.counters[1].record(time.time() - begin)
+                result_queue.put((jpg_dir_path, image, line))
+        except BaseException as e:
+            self.aborted.set()
+            result_queue.put(_PipelineError(e))
+            while frame_queue.get() is not _PIPELINE_DONE:
+                pass
+        finally:
+            result_queue.put(_PIPELINE_DONE)
+
+    def run(self, video_path, on_update=None):
+        """
+        :param:
+            video_path：视频所在目录
+            on_update：每条识别结果计入统计后回调，参数为(jpg_dir_path, PerfStats)
+        :return:
+            {分帧目录: PerfStats}，各目录的data文件按帧顺序写出
+        """
+        self.started = time.time()
+        self.aborted.clear()
+        frame_queue = queue.Queue(self.queue_size)
+        result_queue = queue.Queue(self.queue_size)
+        video_name_list = self.video_util.list_videos(video_path)
+
+        def extract_all():
+            # 任何一个视频分帧出错都通知其他阶段停止，异常经result_queue交给run()
+            try:
+                with ThreadPoolExecutor(max_workers=self.video_util.max_workers) as executor:
+                    futures = [executor.submit(self._extract, video_path, name, frame_queue, result_queue)
+                               for name in video_name_list]
+                    for future in futures:
+                        try:
+                            future.result()
+                        except _PipelineAborted:
+                            pass
+                        except BaseException as e:
+                            self.aborted.set()
+                            result_queue.put(_PipelineError(e))
+            except BaseException as e:
+                self.aborted.set()
+                result_queue.put(_PipelineError(e))
+            finally:
+                for _ in range(self.ocr_workers):
+                    frame_queue.put(_PIPELINE_DONE)
+
+        threads = [threading.Thread(target=extract_all, daemon=True)]
+        threads += [threading.Thread(target=self._ocr, args=(frame_queue, result_queue), daemon=True)
+                    for _ in range(self.ocr_workers)]
+        for t in threads:
+            t.start()
+
+        stats = {}
+        lines = {}
+        known = {}
+        waiting = {}
+
+        def aggregate(jpg_dir_path, image, line):
+            dir_stats = stats.setdefault(jpg_dir_path, PerfStats())
+            if line is not None:
+                lines.setdefault(jpg_dir_path, {})[image] = line
+                dir_stats.add_line(line)
+            if on_update is not None:
+                on_update(jpg_dir_path, dir_stats)
+
+        errors = []
+        running = self.ocr_workers
+        while running:
+            item = result_queue.get()
+            if item is _PIPELINE_DONE:
+                running -= 1
+                continue
+            if isinstance(item, _PipelineError):
+                errors.append(item.error)
+                continue
+            if self.aborted.is_set():
+                continue
+            begin = time.time()
+            jpg_dir_path, image, line = item
+            if isinstance(line, _DuplicateOf):
+                leader_key = (jpg_dir_path, line.leader)
+                if leader_key not in known:
+                    # 重复帧先于它复用的识别结果到达，等结果回来再统计
+                    waiting.setdefault(leader_key, []).append(image)
+                    continue
+                line = known[leader_key]
+            elif self.detector is not None:
+                known[(jpg_dir_path, image)] = line
+            try:
+                aggregate(jpg_dir_path, image, line)
+                for duplicate in waiting.pop((jpg_dir_path, image), ()):
+                    aggregate(jpg_dir_path, duplicate, line)
+            except BaseException as e:
+                # on_update出错时同样停止其他阶段，继续取完队列让各线程正常退出
+                self.aborted.set()
+                errors.append(e)
+            self.counters[2].record(time.time() - begin)
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+        for jpg_dir_path, dir_lines in lines.items():
+            with DataFileWriter(jpg_dir_path + "/data") as writer:
+                for image in sorted(dir_lines):
+                    writer.write(image, dir_lines[image])
+        return stats
+
+
 if __name__ == '__main__':
     video_path = "/Users/vickys/testdir/高拍仪"
-    image_dir_list = VideoProcessUtil().videoToJPG(video_path)
+    manifest = PipelineManifest(video_path + "/manifest")
+    image_dir_list = VideoProcessUtil(manifest=manifest).videoToJPG(video_path)
+
+    with OCRWorkerPool() as pool:
+        for image_dir in image_dir_list:
+            ImageProcessUtil(pool, manifest).process_image_data(image_dir, image_dir + "/" + "data")
 
+    per_file, per_device, fleet = summarize_files([image_dir + "/" + "data" for image_dir in image_dir_list])
     result = ""
-    for image_dir in image_dir_list:
-        ImageProcessUtil().process_image_data(image_dir, image_dir + "/" + "data")
-        result += PerformanceDataProcess().process_data(image_dir + "/" + "data")
+    for file_path, stats in per_file.items():
+        result += stats.report(file_path)
+    for device, stats in per_device.items():
+        result += stats.report(device)
+    result += fleet.report("all")
     print(result)
 
 
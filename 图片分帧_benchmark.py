@@ -0,0 +1,236 @@
+"""
+图片分帧.py 各阶段的性能基准
+    python 图片分帧_benchmark.py --videos 2 --seconds 30 --log-mb 64 --output bench.jsonl
+
+在临时目录里生成合成数据：
+    浮层图片：用PIL把性能数据渲染成文字帧（没有PIL时跳过图片/视频/识别阶段）
+    视频：用ffmpeg把渲染出的帧编码成mp4
+    性能日志：指定大小的data文件
+每个阶段在单独的子进程里运行，报告吞吐、识别耗时分位数、解析速度以及峰值内存，
+结果按行输出JSON，带上当前git提交号，方便不同提交之间对比。
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import 图片分帧
+
+
+def perf_line(rnd):
+    return "CPU %0.1f%% MEM %0.1fMB %0.1f%% GPU %0.1f%%\n" % (
+        rnd.uniform(0, 100), rnd.uniform(100, 4000), rnd.uniform(0, 100), rnd.uniform(0, 100))
+
+
+def write_perf_log(file_path, size_mb, seed=0):
+    """
+    生成约size_mb大小的合成性能日志，带少量OCR常见的缺小数点和识别失败的行
+    """
+    rnd = random.Random(seed)
+    limit = size_mb * 1024 * 1024
+    written = 0
+    with open(file_path, "w") as f:
+        while written < limit:
+            lines = []
+            for _ in range(1000):
+                line = perf_line(rnd)
+                roll = rnd.random()
+                if roll < 0.05:
+                    line = line.replace(".", "", 1)
+                elif roll < 0.06:
+                    line = "MB\n"
+                lines.append(line)
+            chunk = "".join(lines)
+            f.write(chunk)
+            written += len(chunk)
+    return file_path
+
+
+def render_overlay_frames(frame_dir, count, size=(640, 360), seed=0):
+    """
+    用PIL渲染带性能数据浮层的帧，每隔几帧数据才变一次，模拟真实录屏里的静止片段
+    """
+    from PIL import Image, ImageDraw
+    rnd = random.Random(seed)
+    os.makedirs(frame_dir, exist_ok=True)
+    text = perf_line(rnd)
+    for index in range(1, count + 1):
+        if index % 3 == 0:
+            text = perf_line(rnd)
+        image = Image.new("RGB", size, (20, 20, 20))
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((0, 0, size[0], 40), fill=(255, 255, 255))
+        draw.text((10, 12), text.strip(), fill=(0, 0, 0))
+        image.save(frame_dir + "/%05d.png" % index)
+    return frame_dir
+
+
+def write_video(video_file_path, seconds, seed=0):
+    frame_dir = tempfile.mkdtemp()
+    try:
+        render_overlay_frames(frame_dir, seconds, seed=seed)
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-framerate", "1", "-i", frame_dir + "/%05d.png",
+                        "-c:v", "mpeg4", "-q:v", "2", "-pix_fmt", "yuv420p", video_file_path], check=True)
+    finally:
+        shutil.rmtree(frame_dir)
+    return video_file_path
+
+
+def percentile(values, q):
+    """
+    与numpy.percentile默认的linear方法相同
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = q / 100 * (len(values) - 1)
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (rank - lower) * (values[upper] - values[lower])
+
+
+def peak_rss_mb():
+    """
+    当前进程以及已结束子进程（ffmpeg/tesseract）的峰值内存
+    """
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / scale, children / scale
+
+
+def bench_extract(video_path):
+    begin = time.perf_counter()
+    image_dir_list = 图片分帧.VideoProcessUtil().videoToJPG(video_path)
+    elapsed = time.perf_counter() - begin
+    frames = sum(len(图片分帧.list_frame_images(image_dir)) for image_dir in image_dir_list)
+    return {"frames": frames, "seconds": elapsed, "frames_per_sec": frames / elapsed if elapsed else 0}
+
+
+def bench_ocr(image_dir_list):
+    backend = 图片分帧.default_ocr_backend()
+    latencies = []
+    for image_dir in image_dir_list:
+        for image in 图片分帧.list_frame_images(image_dir):
+            begin = time.perf_counter()
+            backend.image_to_string(image_dir + "/" + image)
+            latencies.append(time.perf_counter() - begin)
+    begin = time.perf_counter()
+    with 图片分帧.OCRWorkerPool() as pool:
+        for image_dir in image_dir_list:
+            图片分帧.ImageProcessUtil(pool).process_image_data(image_dir, image_dir + "/data")
+    elapsed = time.perf_counter() - begin
+    result = {"frames": len(latencies), "pool_frames_per_sec": len(latencies) / elapsed if elapsed else 0}
+    for q in (50, 95, 99):
+        result["latency_p%d_ms" % q] = percentile(latencies, q) * 1000
+    return result
+
+
+def bench_parse(file_path, mode):
+    process = 图片分帧.PerformanceDataProcess()
+    size_mb = os.path.getsize(file_path) / 1024 / 1024
+    devnull = open(os.devnull, "w")
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        begin = time.perf_counter()
+        if mode == "readlines":
+            process.process_data(file_path)
+        elif mode == "streaming":
+            process.process_data(file_path, streaming=True)
+        elif mode == "mmap":
+            process.process_data_mmap(file_path)
+        else:
+            process.process_data_numpy(file_path)
+        elapsed = time.perf_counter() - begin
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    return {"mode": mode, "mb": size_mb, "seconds": elapsed, "mb_per_sec": size_mb / elapsed if elapsed else 0}
+
+
+def _run_stage(fn, args):
+    result = fn(*args)
+    result["peak_rss_mb"], result["children_peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_isolated(name, fn, *args):
+    """
+    每个阶段用新进程运行，峰值内存互不影响
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        result = executor.submit(_run_stage, fn, args).result()
+    result["stage"] = name
+    return result
+
+
+def git_revision():
+    p = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+    return p.stdout.decode().strip() or None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="图片分帧 pipeline benchmark")
+    parser.add_argument("--videos", type=int, default=2, help="合成视频个数")
+    parser.add_argument("--seconds", type=int, default=30, help="每个视频的时长（秒）")
+    parser.add_argument("--log-mb", type=int, default=64, help="合成性能日志大小（MB）")
+    parser.add_argument("--output", help="结果追加写入的jsonl文件")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="frame_bench_")
+    revision = git_revision()
+    results = []
+    try:
+        log_path = write_perf_log(work_dir + "/data", args.log_mb)
+        modes = ["readlines", "streaming", "mmap"] + (["numpy"] if 图片分帧.np is not None else [])
+        for mode in modes:
+            results.append(run_isolated("parse", bench_parse, log_path, mode))
+
+        can_render = shutil.which("ffmpeg") is not None
+        try:
+            import PIL
+        except ImportError:
+            can_render = False
+        if can_render:
+            video_path = work_dir + "/videos"
+            os.mkdir(video_path)
+            for i in range(args.videos):
+                write_video(video_path + "/synthetic_%02d.mp4" % i, args.seconds, seed=i)
+            extract = run_isolated("extract", bench_extract, video_path)
+            results.append(extract)
+            image_dir_list = [video_path + "/synthetic_%02d" % i for i in range(args.videos)]
+            if shutil.which("tesseract") is not None:
+                results.append(run_isolated("ocr", bench_ocr, image_dir_list))
+        else:
+            print("ffmpeg or PIL missing, skipping extract/ocr stages", file=sys.stderr)
+    finally:
+        if args.keep:
+            print("work dir: %s" % work_dir, file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir)
+
+    out = open(args.output, "a") if args.output else None
+    try:
+        for result in results:
+            result["revision"] = revision
+            line = json.dumps(result, ensure_ascii=False)
+            print(line)
+            if out is not None:
+                out.write(line + "\n")
+    finally:
+        if out is not None:
+            out.close()
+    return results
+
+
+if __name__ == '__main__':
+    main()